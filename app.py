@@ -1,126 +1,229 @@
 # Standard packages
 import os
-import sys
-import pickle
+import time
 import logging
 from datetime import datetime
 from pathlib import Path
 import unidecode
 
 # Web utilities
-import ndjson
-import requests
+import click
 from dotenv import load_dotenv
-from dotenv.main import resolve_nested_variables
 
-from flask import Flask, json, jsonify, session
-from flask import url_for, redirect, request
+from flask import Blueprint, Flask, Response, current_app, json, jsonify
+from flask import url_for, request
 from flask_cors import CORS, cross_origin
 
-import ndjson
-
-import pickle
-import logging
-
-from dotenv import load_dotenv
-from requests.api import head
-import base64
-
-from authlib.integrations.flask_client import OAuth
-from models import db, Event, Game, Member, Fixture, User
 from flask_login import (
     LoginManager,
     current_user,
-    login_required,
     login_user,
     logout_user,
 )
 
-# Authentication/Authorization imports
-from oauthlib.oauth2 import WebApplicationClient
-from authlib.integrations.flask_client import OAuth
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-
 # Database internal imports
-from models import User, db, Event, Game, Member, Fixture
-from mock_db import initialize_mock_db
-from db_ops import get_user, create_user, validate_game, add_game_to_db, update_acl_elo
+from models import User, db, Event, Member
+from db_ops import get_user
 import db_ops
+import ingest_queue
+import live_updates
+import metrics
+import response_cache
+import user_cache
+
+# google-auth, authlib and requests (through google_jwt, lichess, importer and mock_db) are imported where they
+# are first used, so that importing this module and creating the app stays cheap for every server worker.
+# benchmarks/startup.py measures this against a time budget.
+
+FIXTURES_PAGE_SIZE = 100
+FIXTURES_MAX_PAGE_SIZE = 1000
+RATING_HISTORY_POINTS = 500
+RATING_HISTORY_MAX_POINTS = 5000
+
+# Routes and CLI commands live on a blueprint so that create_app can be called once per process (or per test)
+api = Blueprint('api', __name__, cli_group=None)
+login_manager = LoginManager()
 
-# Initialize environment, log and flask app
-load_dotenv()
 
-log_dir = Path('./.logs')
-log_dir.mkdir(exist_ok=True, parents=True)
+def create_app(config=None):
+    # Creating the app does not touch the database. Use `flask init-db` (or `flask seed-mock-db`) to set it up
+    load_dotenv()
 
-log_path = log_dir / datetime.now().strftime('%Y%m%d.log')
+    app = Flask(__name__)
+    CORS(app, support_credentials=True)
 
-app = Flask(__name__)
-app.app_context().push()
-CORS(app, support_credentials=True)
-login_manager = LoginManager()
+    app.secret_key = os.getenv("SECRET_KEY")
+    app.logger.setLevel(logging.DEBUG)
 
-app.secret_key = os.getenv("SECRET_KEY") or os.urandom(128)
-app.logger.debug(f'Secret Key: {app.secret_key}')
+    # Configure flask app with environment variables, then with the explicit config (if any)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+    app.config['RESPONSE_CACHE_SIZE'] = int(os.getenv("RESPONSE_CACHE_SIZE", 64))
+    app.config['USER_CACHE_SIZE'] = int(os.getenv("USER_CACHE_SIZE", 1024))
+    app.config['USER_CACHE_TTL'] = int(os.getenv("USER_CACHE_TTL", 300))  # Seconds. Bounds staleness across processes
+    app.config['SESSION_USER_SNAPSHOT'] = os.getenv("SESSION_USER_SNAPSHOT", '').lower() in ['1', 'true']
+    app.config['SQL_QUERY_BUDGET'] = int(os.getenv("SQL_QUERY_BUDGET", 30))
+    app.config['PROFILER_SAMPLE_RATE'] = float(os.getenv("PROFILER_SAMPLE_RATE", 0))
+    app.config['INGEST_MODE'] = os.getenv("INGEST_MODE", 'sync')  # 'queue' makes POST /game return 202 with a job id
+    app.config['INGEST_WORKERS'] = int(os.getenv("INGEST_WORKERS", 4))
+    app.config['PROJECTION_SIMULATIONS'] = int(os.getenv("PROJECTION_SIMULATIONS", 100_000))
+    app.config['PROJECTION_WORKERS'] = int(os.getenv("PROJECTION_WORKERS", 0))  # Processes per projection, 0 runs in the request
 
-# filehandler = logging.FileHandler(log_path)
+    app.config['LICHESS_CLIENT_ID'] =  os.getenv("LICHESS_CLIENT_ID")
+    app.config['LICHESS_CLIENT_SECRET'] = os.getenv("LICHESS_CLIENT_SECRET")
+    app.config['LICHESS_ACCESS_TOKEN_URL'] = 'https://oauth.lichess.org/oauth'
+    app.config['LICHESS_AUTHORIZE_URL'] = 'https://oauth.lichess.org/oauth/authorize'
 
-# app.logger.addHandler(handler)
-# app.logger.addHandler(filehandler)
-app.logger.setLevel(logging.DEBUG)
+    if config is not None:
+        app.config.update(config)
 
-app.logger.info('===== Log has been initialized. New run starts here. =====')
+    if not app.secret_key:
+        # A random key is per process: sessions signed by one worker are rejected by the others and by the next run
+        if not (app.debug or app.testing):
+            app.logger.warning('SECRET_KEY is not set. Using a random key, so logins will not survive across '
+                               'workers or restarts')
+        app.secret_key = os.urandom(24)
 
+    # Initialize SQL Database
+    db.init_app(app)
+    login_manager.init_app(app)
+    response_cache.configure(app.config['RESPONSE_CACHE_SIZE'])
+    user_cache.configure(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'], app.config['SESSION_USER_SNAPSHOT'])
+    metrics.init_app(app)
+    ingest_queue.init_app(app)
+    live_updates.init_app(app)
 
-# Configure flask app with environment variables
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("SQLALCHEMY_DATABASE_URI")
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
+    app.register_blueprint(api)
 
-app.config['LICHESS_CLIENT_ID'] =  os.getenv("LICHESS_CLIENT_ID")
-app.config['LICHESS_CLIENT_SECRET'] = os.getenv("LICHESS_CLIENT_SECRET")
-app.config['LICHESS_ACCESS_TOKEN_URL'] = 'https://oauth.lichess.org/oauth'
-app.config['LICHESS_AUTHORIZE_URL'] = 'https://oauth.lichess.org/oauth/authorize'
+    app.logger.info('===== App has been created. New run starts here. =====')
+    return app
 
-app.secret_key = os.getenv("SECRET_KEY") or os.urandom(24)
 
-login_manager = LoginManager()
-login_manager.init_app(app)
+def get_lichess_oauth():
+    # Authlib is only imported, and the lichess client registered, the first time a lichess OAuth route is hit
+    if 'lichess_oauth' not in current_app.extensions:
+        from authlib.integrations.flask_client import OAuth
+        oauth = OAuth(current_app._get_current_object())
+        oauth.register('lichess')
+        current_app.extensions['lichess_oauth'] = oauth.create_client('lichess')
+
+    return current_app.extensions['lichess_oauth']
+
 
-# Initialize SQL Database
-db.init_app(app)
-login_manager.init_app(app)
+def get_google_provider_cfg():
+    # TODO Add error handling in case google API returns a failure
+    import google_jwt
+    return google_jwt.discovery_document.get()
+
+
+@api.cli.command('init-db')
+def init_db_command():
+    # Creates missing tables only, so it is safe to run on every deploy
+    db.create_all()
+    click.echo('Database tables created')
+
+
+@api.cli.command('seed-mock-db')
+@click.option('--input-games', type=click.Path(), default='test_data/acl1_gamelist.json',
+              help='Gamelist to import (skipped if the file does not exist)')
+@click.confirmation_option(prompt='This drops every table and reseeds the database. Continue?')
+def seed_mock_db_command(input_games):
+    from mock_db import initialize_mock_db
+    input_games_path = Path(input_games)
+    initialize_mock_db(db, current_app, input_games=input_games_path if input_games_path.exists() else None)
+
+
+@api.cli.command('ingest-worker')
+@click.option('--workers', type=int, default=None, help='Worker threads (defaults to INGEST_WORKERS)')
+def ingest_worker_command(workers):
+    # Standalone queue consumer, e.g. to process jobs outside the web server processes
+    if workers is not None:
+        current_app.config['INGEST_WORKERS'] = workers
+    pool = ingest_queue.start_workers(current_app._get_current_object())
+    click.echo(f'Processing ingest jobs with {len(pool.threads)} workers. Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pool.stop()
 
-app.logger.debug(f'WERKZEUG_RUN_MAIN = {os.getenv("WERKZEUG_RUN_MAIN")}')
 
-if os.environ.get("WERKZEUG_RUN_MAIN") is None:
-    app.logger.info('Initializing database...')
-    input_games_path = Path('test_data/acl1_gamelist.json')
-    initialize_mock_db(db, app, input_games= input_games_path if input_games_path.exists() else None)
+@api.cli.command('rebuild-standings')
+@click.option('--event-id', type=int, default=None, help='Only rebuild this event (defaults to all events)')
+def rebuild_standings_command(event_id):
+    db_ops.rebuild_standings(event_id)
 
 
-# OAuth setup (lichess and google)
-GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", None)
-GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_CLIENT_SECRET", None)
-GOOGLE_DISCOVERY_URL = (
-    "https://accounts.google.com/.well-known/openid-configuration"
-)
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+@api.cli.command('close-event')
+@click.option('--event-id', type=int, required=True)
+def close_event_command(event_id):
+    db_ops.close_event(event_id)
 
-def get_google_provider_cfg():
-    # TODO Add error handling in case google API returns a failure
-    return requests.get(GOOGLE_DISCOVERY_URL).json()
+
+@api.cli.command('set-tiebreaks')
+@click.option('--event-id', type=int, required=True)
+@click.argument('tiebreaks', nargs=-1)
+def set_tiebreaks_command(event_id, tiebreaks):
+    # e.g. flask set-tiebreaks --event-id 1 direct_encounter sonneborn_berger wins. No tiebreaks ranks on points only
+    db_ops.set_tiebreak_order(event_id, tiebreaks)
+
+
+@api.cli.command('recompute-ratings')
+@click.option('--k-factor', type=float, default=db_ops.K_FACTOR)
+@click.option('--initial-rating', type=float, default=db_ops.INITIAL_RATING)
+def recompute_ratings_command(k_factor, initial_rating):
+    db_ops.recompute_ratings(k_factor=k_factor, initial_rating=initial_rating)
+
+
+@api.cli.command('import-games')
+@click.argument('gamelist', type=click.Path(exists=True))
+@click.option('--base-url', default=None, help='Lichess (or stand-in) server to fetch exports from')
+@click.option('--workers', type=int, default=8, help='Concurrent export downloads')
+def import_games_command(gamelist, base_url, workers):
+    import importer
+    import lichess
+    client = lichess.LichessClient(base_url=base_url) if base_url else None
+    imported = importer.import_gamelist(gamelist, client=client, max_workers=workers)
+    click.echo(f'Imported {len(imported)} games')
+
+
+@api.cli.command('migrate-game-exports')
+def migrate_game_exports_command():
+    migrated = db_ops.migrate_game_exports()
+    click.echo(f'Moved {migrated} game exports to game_exports')
+
+
+@api.cli.command('schedule-event')
+@click.option('--event-id', type=int, required=True)
+@click.option('--cycles', type=int, default=1, help='Round-robin cycles (2 for a double round-robin)')
+def schedule_event_command(event_id, cycles):
+    import scheduler
+    event = Event.query.get(event_id)
+    if event is None:
+        raise click.ClickException(f'Event {event_id} not found')
+
+    try:
+        created = scheduler.schedule_event(event, cycles=cycles)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Created {created} fixtures')
+
+
+@api.cli.command('rate-round')
+@click.option('--event-id', type=int, required=True)
+@click.option('--round', 'round_number', type=int, required=True)
+def rate_round_command(event_id, round_number):
+    db_ops.rate_glicko2_round(event_id, round_number)
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return get_user(user_id)
+    # Served from user_cache (or the session) on most requests
+    return user_cache.load(user_id, get_user)
 
-oauth = OAuth(app)
-oauth.register('lichess')
 
 # API Routes
-@app.route('/')
+@api.route('/')
 def main():
     response = (
                 "<h3>Welcome to the backend!</h3>"
@@ -134,7 +237,7 @@ def main():
     return response
 
 
-@app.route('/debug')
+@api.route('/debug')
 def debug():
     data = {'current_user': current_user.json() if current_user.is_authenticated else None,
             'test_decode': unidecode.unidecode('François')}
@@ -142,99 +245,309 @@ def debug():
     return jsonify(data)
 
 
-@app.route('/connect_lichess')
+@api.route('/connect_lichess')
 def connect_lichess():
     # Not currently used. Lichess connection might be better handled by frontend
-    app.logger.debug('Accessing connect_lichess endpoint')
-    redirect_uri = url_for("authorize_lichess", _external=True)
-    app.logger.debug(f'Redirecting to {redirect_uri}')
+    current_app.logger.debug('Accessing connect_lichess endpoint')
+    redirect_uri = url_for("api.authorize_lichess", _external=True)
+    current_app.logger.debug(f'Redirecting to {redirect_uri}')
 
     """
     If you need to append scopes to your requests, add the `scope=...` named argument
     to the `.authorize_redirect()` method. For admissible values refer to https://lichess.org/api#section/Authentication. 
     Example with scopes for allowing the app to read the user's email address:
-    `return oauth.lichess.authorize_redirect(redirect_uri, scope="email:read")`
+    `return get_lichess_oauth().authorize_redirect(redirect_uri, scope="email:read")`
     """
-    return oauth.lichess.authorize_redirect(redirect_uri, scope="email:read")
+    return get_lichess_oauth().authorize_redirect(redirect_uri, scope="email:read")
 
 
-@app.route('/authorize_lichess')
+@api.route('/authorize_lichess')
 def authorize_lichess():
     # Not currently used. Lichess authorization might be better handled by frontend
-    token = oauth.lichess.authorize_access_token()
+    token = get_lichess_oauth().authorize_access_token()
 
+    import lichess
     bearer = token['access_token']
-    headers = {'Authorization': f'Bearer {bearer}'}
-
-    response = requests.get(f"https://lichess.org/api/account", headers=headers)
+    lichess_data = lichess.get_client().get_account(bearer)
 
-    # db_ops.update_user_lichess_data(current_user.id, response.json())
+    # db_ops.update_user_lichess_data(current_user.id, lichess_data)
 
-    return jsonify({'lichess_data': response.json()})
+    return jsonify({'lichess_data': lichess_data})
 
 
-@app.route('/games')
+@api.route('/games')
 def get_games():
     # Not currently used. Just for early api testing.
+    # ?stream=1 (or Accept: application/x-ndjson) streams league games back as NDJSON while they are read upstream
     username = request.args.get('username')
-    headers = {'Accept': 'application/x-ndjson'}
-
-    response = requests.get(f"https://lichess.org/api/games/user/{username}", headers=headers)
-    all_games = (response.json(cls=ndjson.Decoder))
-
-    league_members = ['joaopf', 'dodo900', 'gspenny', 'hiperlicious', 'MrUnseen', 'eduardodsp', 'fckoch', 'guischmitd']
-    league_members.remove(username)
+    params = {k: request.args[k] for k in ['since', 'until', 'max'] if k in request.args}
+    stream = request.args.get('stream', '').lower() in ['1', 'true'] \
+             or request.accept_mimetypes.best == 'application/x-ndjson'
 
-    league_games = []
-    for game in all_games:
-        white, black = None, None
+    import lichess
+    league_members = {member_id for member_id, in db.session.query(Member.lichess_id)}
+    league_members.discard(username.lower())
 
-        if 'user' in game['players']['white']:
-            white = game['players']['white']['user']['id']
+    def is_league_game(game):
+        white = game['players']['white'].get('user', {}).get('id')
+        black = game['players']['black'].get('user', {}).get('id')
+        return white in league_members or black in league_members
 
-        if 'user' in game['players']['black']:
-            black = game['players']['black']['user']['id']
+    league_games = (game for game in lichess.get_client().user_games(username, **params) if is_league_game(game))
 
-        if white in league_members or black in league_members:
-            league_games.append(game)
+    if stream:
+        return Response((json.dumps(game) + '\n' for game in league_games), mimetype='application/x-ndjson')
 
+    league_games = list(league_games)
     return jsonify({'n_league_games': len(league_games), 'username': username, 'league_games': league_games})
 
 
-@app.route('/game', methods=['POST', 'OPTIONS'])
+@api.route('/game', methods=['POST', 'OPTIONS'])
 @cross_origin(supports_credentials=True)
 def add_game():
     # This endpoint will be called only after user confirmation on the frontend
     data = json.loads(request.data.decode())
     fixture_id = data['fixture_id']
     lichess_gamedata = data['data']
-    validation_data = validate_game(fixture_id, lichess_gamedata)
 
-    if all([v for k, v in validation_data.items()]):
-        add_game_to_db(fixture_id, lichess_gamedata)
-        update_acl_elo(fixture_id)
+    if current_app.config['INGEST_MODE'] == 'queue':
+        # Processed by the ingest workers. Poll the job for the validation result
+        job = ingest_queue.enqueue(fixture_id, lichess_gamedata)
+        status_url = url_for('api.game_job', job_id=job.id)
+        response = jsonify({'job_id': job.id, 'status': job.status, 'status_url': status_url})
+        response.status_code = 202
+        response.headers['Location'] = status_url
+        return response
 
-    else:
-        app.logger.warn('Invalid game!')
+    validation_data = db_ops.accept_game(fixture_id, lichess_gamedata)
+
+    if not all([v for k, v in validation_data.items()]):
+        current_app.logger.warn('Invalid game!')
         for k, v in validation_data.items():
-            app.logger.warn('{k} = {v}')
+            current_app.logger.warn(f'{k} = {v}')
     
-    return jsonify({'validation': validation_data, 'ranking': db_ops.get_ranking_data(), 'fixtures': db_ops.get_fixtures()})
+    ranking_data, _, _ = response_cache.get_payload(*ranking_payload())
+    fixtures_data, _, _ = response_cache.get_payload(*fixtures_payload())
+
+    return jsonify({'validation': validation_data, 'ranking': ranking_data, 'fixtures': fixtures_data})
+
+
+@api.route('/game/jobs/<int:job_id>')
+@cross_origin(supports_credentials=True)
+def game_job(job_id):
+    job = ingest_queue.get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+
+    return jsonify(job.json())
+
+
+@api.route('/game/<game_id>/raw')
+@cross_origin(supports_credentials=True)
+def game_raw(game_id):
+    lichess_gamedata = db_ops.get_game_export(game_id)
+    if lichess_gamedata is None:
+        return jsonify({'error': f'Game {game_id} not found'}), 404
 
+    return jsonify(lichess_gamedata)
 
-@app.route('/ranking')
+
+@api.route('/games/batch', methods=['POST', 'OPTIONS'])
+@cross_origin(supports_credentials=True)
+def add_games_batch():
+    # Body is a list of {'fixture_id', 'data'} items, as in /game. Valid items are accepted together
+    submissions = json.loads(request.data.decode())
+    validations, accepted = db_ops.validate_games(submissions)
+    accepted_ids, lost = db_ops.add_games_to_db(accepted)
+    accepted_ids = set(accepted_ids)
+
+    results = []
+    for submission, validation in zip(submissions, validations):
+        game_id = submission['data']['id']
+        if all(validation.values()) and game_id in lost:
+            # Valid when checked, then a concurrent submission took the fixture or stored the game first
+            validation = {**validation, **lost[game_id]}
+        results.append({'fixture_id': submission['fixture_id'], 'game_id': game_id,
+                        'accepted': game_id in accepted_ids and all(validation.values()), 'validation': validation})
+
+    ranking_data, _, _ = response_cache.get_payload(*ranking_payload())
+    fixtures_data, _, _ = response_cache.get_payload(*fixtures_payload())
+
+    return jsonify({'results': results, 'n_accepted': len(accepted_ids),
+                    'ranking': ranking_data, 'fixtures': fixtures_data})
+
+
+@api.route('/stream')
+@cross_origin(supports_credentials=True)
+def stream():
+    # Server-Sent Events. Every accepted game sends a 'game' event with its fixture, both members' new standing
+    # and the event's data version. 'versions' (games accepted by another process) and 'reset' (missed too much)
+    # mean the client should refetch. Reconnecting clients get what they missed since their Last-Event-ID
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    subscription = live_updates.subscribe(current_app._get_current_object(), last_event_id)
+
+    response = Response(live_updates.stream(subscription, current_app.config['STREAM_HEARTBEAT']),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stops nginx from buffering the stream
+    return response
+
+
+def ranking_payload(event_id=None):
+    # Standings of one event (the active one by default). Closed events are served from their frozen snapshot
+    if event_id is None:
+        event_id = db_ops.get_active_event_id()
+    key = ('ranking', event_id, db_ops.get_data_version(event_id))
+    return key, lambda: db_ops.get_ranking_data(event_id)
+
+
+def fixtures_payload():
+    key = ('fixtures', db_ops.get_data_version())
+    return key, db_ops.get_fixtures
+
+
+@api.route('/ranking')
 @cross_origin(supports_credentials=True)
 def ranking():
-    return jsonify(db_ops.get_ranking_data())
+    event_id = request.args.get('event_id', type=int)
+    if event_id is not None and db_ops.get_data_version(event_id) is None:
+        return jsonify({'error': f'Event {event_id} not found'}), 404
+
+    return response_cache.cached_json_response(*ranking_payload(event_id))
 
 
-@app.route('/fixtures')
+@api.route('/events/<int:event_id>/standings')
+@cross_origin(supports_credentials=True)
+def event_standings(event_id):
+    version = db_ops.get_data_version(event_id)
+    if version is None:
+        return jsonify({'error': f'Event {event_id} not found'}), 404
+
+    return response_cache.cached_json_response(('standings', event_id, version),
+                                               lambda: db_ops.get_event_standings(event_id))
+
+
+@api.route('/fixtures')
 @cross_origin(supports_credentials=True)
 def fixtures():
-    return jsonify(db_ops.get_fixtures())
+    # No arguments: every fixture (the original response). Any filter or pagination argument switches to
+    # {'fixtures', 'next_cursor'[, 'total']}. Filters: event_id, round_number, player, status=open|fulfilled,
+    # deadline_from/deadline_to (YYYY-MM-DD). Pagination: limit (default 100) and after=<next_cursor>.
+    if not request.args:
+        return response_cache.cached_json_response(*fixtures_payload())
+
+    try:
+        filters = {'event_id': parse_int_arg('event_id'),
+                   'round_number': parse_int_arg('round_number'),
+                   'player': request.args.get('player'),
+                   'status': request.args.get('status'),
+                   'deadline_from': parse_date_arg('deadline_from'),
+                   'deadline_to': parse_date_arg('deadline_to')}
+        after = parse_int_arg('after')
+        limit = parse_int_arg('limit', FIXTURES_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if filters['status'] not in [None, 'open', 'fulfilled']:
+        return jsonify({'error': 'status must be open or fulfilled'}), 400
+
+    limit = min(limit, FIXTURES_MAX_PAGE_SIZE)
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    with_total = request.args.get('total', '').lower() in ['1', 'true']
+
+    def build():
+        page = db_ops.get_fixtures(after=after, limit=limit, **filters)
+        payload = {'fixtures': page, 'next_cursor': page[-1]['id'] if len(page) == limit else None}
+        if with_total:
+            payload['total'] = db_ops.count_fixtures(**filters)
+        return payload
+
+    key = ('fixtures', tuple(sorted(request.args.items())), db_ops.get_data_version())
+    return response_cache.cached_json_response(key, build)
+
+
+@api.route('/members/<member_id>/rating-history')
+@cross_origin(supports_credentials=True)
+def rating_history(member_id):
+    # ACL Elo after every game, oldest first. from/to (YYYY-MM-DD) restrict the range. Histories longer than
+    # max_points (default 500) are merged into that many points, each with the low/high of the games it covers
+    try:
+        date_from, date_to = parse_date_arg('from'), parse_date_arg('to')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    max_points = min(request.args.get('max_points', RATING_HISTORY_POINTS, type=int), RATING_HISTORY_MAX_POINTS)
+    if max_points < 1:
+        return jsonify({'error': 'max_points must be positive'}), 400
+
+    if Member.query.get(member_id) is None:
+        return jsonify({'error': f'Member {member_id} not found'}), 404
+
+    def build():
+        history = db_ops.get_rating_history(member_id, date_from, date_to, max_points)
+        return {'member_id': member_id, 'downsampled': any('games' in point for point in history), 'history': history}
+
+    key = ('rating-history', member_id, date_from, date_to, max_points, db_ops.get_data_version())
+    return response_cache.cached_json_response(key, build)
+
+
+@api.route('/events/<int:event_id>/crosstable')
+@cross_origin(supports_credentials=True)
+def event_crosstable(event_id):
+    # Head-to-head matrices, rows and columns in standings order: entry [i][j] is members[i] against members[j]
+    version = db_ops.get_data_version(event_id)
+    if version is None:
+        return jsonify({'error': f'Event {event_id} not found'}), 404
+
+    return response_cache.cached_json_response(('crosstable', event_id, version),
+                                               lambda: db_ops.get_crosstable(event_id))
+
+
+@api.route('/events/<int:event_id>/projections')
+@cross_origin(supports_credentials=True)
+def event_projections(event_id):
+    # Qualification and finishing position probabilities, from simulating the event's open fixtures
+    version = db_ops.get_data_version(event_id)
+    if version is None:
+        return jsonify({'error': f'Event {event_id} not found'}), 404
+
+    n_simulations = current_app.config['PROJECTION_SIMULATIONS']
+    # Seeded by event and version, so every worker process builds the same payload (and ETag) for a version
+    build = lambda: db_ops.get_projections(event_id, n_simulations, workers=current_app.config['PROJECTION_WORKERS'],
+                                           seed=[event_id, version])
+    return response_cache.cached_json_response(('projections', event_id, version, n_simulations), build)
+
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'{name} must be a YYYY-MM-DD date')
+
+
+def parse_int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be an integer')
+
+
+@api.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
-@app.route('/login', methods=['POST', 'OPTIONS'])
+@api.route('/login', methods=['POST', 'OPTIONS'])
 @cross_origin(supports_credentials=True)
 def login():
     payload = json.loads(request.data)
@@ -250,7 +563,7 @@ def login():
             status = 'existing_user_login'
 
         else:
-            app.logger.debug(f'User {user_data["sub"]} is not registered. Creating new user')
+            current_app.logger.debug(f'User {user_data["sub"]} is not registered. Creating new user')
             name_parts = user_data['name'].split(' ')
             username = ''.join([part[0] for part in name_parts[:-1]] + [name_parts[-1]]).lower()
             username = unidecode.unidecode(username)
@@ -262,6 +575,7 @@ def login():
             status = 'new_user_registered'
 
         res = login_user(user)
+        user_cache.remember_in_session(user)
 
     else:
         # Invalid token
@@ -271,18 +585,21 @@ def login():
     return jsonify({'login_status': status, 'current_user': current_user.json(), 'login_success': res})
 
 
-@app.route('/logout', methods=['POST', 'OPTIONS'])
+@api.route('/logout', methods=['POST', 'OPTIONS'])
 @cross_origin(supports_credentials=True)
 def logout():
     result = logout_user()
-    app.logger.debug(result)
+    user_cache.forget_session()
+    current_app.logger.debug(result)
     return jsonify({'logout_result': result, 'current_user': current_user if not result else None})
 
 
 def validate_google_JWT(gtoken):
+    import google_jwt
     try:
         # Specify the CLIENT_ID of the app that accesses the backend:
-        idinfo = id_token.verify_oauth2_token(gtoken.encode('utf-8'), google_requests.Request(), os.getenv("FRONTEND_GOOGLE_CLIENT_ID"))
+        # Signing certificates are cached by google_jwt, so this normally does no network I/O
+        idinfo = google_jwt.verify_id_token(gtoken, os.getenv("FRONTEND_GOOGLE_CLIENT_ID"))
         
         # Or, if multiple clients access the backend server:
         # idinfo = id_token.verify_oauth2_token(token, requests.Request())
@@ -294,19 +611,19 @@ def validate_google_JWT(gtoken):
         #     raise ValueError('Wrong hosted domain.')
 
         # ID token is valid. Get the user's Google Account ID from the decoded token.
-        app.logger.debug('Valid token for user ' + idinfo['sub'])
+        current_app.logger.debug('Valid token for user ' + idinfo['sub'])
         return idinfo
         
     except ValueError:
         # Invalid token
-        app.logger.debug('Invalid Token')
+        current_app.logger.debug('Invalid Token')
         return False
 
 
 if __name__ == "__main__":
     # use_reloader=False prevents flask from running twice in debug mode
-    app.run(debug=True, use_reloader=True)
+    create_app().run(debug=True, use_reloader=True)
     
     # # Generate certificates and add authority to chrome so you can run flask in https
     # # https://stackoverflow.com/questions/7580508/getting-chrome-to-accept-self-signed-localhost-certificate
-    # app.run(debug=True, ssl_context=(".cert/localhost.crt", ".cert/localhost.key"))
+    # create_app().run(debug=True, ssl_context=(".cert/localhost.crt", ".cert/localhost.key"))
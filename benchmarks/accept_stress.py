@@ -0,0 +1,113 @@
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+import db_ops
+from models import db, Fixture, Game, Member, Standing
+from benchmarks.synthetic import make_app, create_league, fixture_submissions
+
+# Multi-threaded stress test of db_ops.accept_game.
+#   python -m benchmarks.accept_stress --database-uri sqlite:////tmp/stress.db --threads 16
+# Phase 1 has every thread race for the same fixtures with different games (each fixture must be filled
+# exactly once). Phase 2 submits a full round-robin concurrently, so most in-flight games share a member
+# (no rating update may be lost: Elo is zero-sum, so the rating total must not move).
+
+
+def submit_all(app, submissions, n_threads, retries=5):
+    results, errors = Counter(), Counter()
+    lock = threading.Lock()
+    queue = list(reversed(submissions))
+
+    def worker():
+        with app.app_context():
+            while True:
+                with lock:
+                    if not queue:
+                        break
+                    submission = queue.pop()
+
+                for attempt in range(retries):
+                    try:
+                        validation = db_ops.accept_game(submission['fixture_id'], submission['data'])
+                        break
+                    except OperationalError as e:
+                        # SQLite gives up waiting for the write lock eventually. Count it and retry
+                        db.session.rollback()
+                        with lock:
+                            errors[type(e.orig).__name__] += 1
+                else:
+                    validation = {'gave_up': False}
+
+                with lock:
+                    results['accepted' if all(validation.values()) else 'rejected'] += 1
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results, errors, time.perf_counter() - start
+
+
+def check_invariants(n_members):
+    n_games = Game.query.count()
+    n_filled = Fixture.query.filter(Fixture.game_id.isnot(None)).count()
+    games_counted = db.session.query(func.sum(Standing.games_played)).scalar() or 0
+    rating_total = db.session.query(func.sum(Member.acl_elo)).scalar()
+
+    # Integer rating columns round on some databases, so allow up to one point of drift per game
+    tolerance = 1e-6 if db.engine.dialect.name == 'sqlite' else n_games
+
+    return {'games': n_games,
+            'fixtures_filled_once': n_filled == n_games,
+            'standings_consistent': games_counted == 2 * n_games,
+            'ratings_conserved': abs(rating_total - 1000 * n_members) <= tolerance}
+
+
+def run(database_uri, n_members, n_threads, contenders):
+    app = make_app(database_uri)
+    report = {'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0], 'members': n_members,
+              'threads': n_threads}
+
+    with app.app_context():
+        create_league(n_members)
+        fixtures = Fixture.query.order_by(Fixture.id).all()
+        n_contested = max(1, len(fixtures) // 10)
+        # Several different games (different ids) for each of the first fixtures
+        contested = [dict(s, data=dict(s['data'], id=f'{s["data"]["id"]}{c}'))
+                     for s in fixture_submissions(fixtures[:n_contested]) for c in range(contenders)]
+        rest = fixture_submissions(fixtures[n_contested:], seed=1)
+        db.session.remove()
+
+    for phase, submissions in [('contended_fixtures', contested), ('shared_members', rest)]:
+        results, errors, seconds = submit_all(app, submissions, n_threads)
+        report[phase] = {'submissions': len(submissions), 'accepted': results['accepted'],
+                         'rejected': results['rejected'], 'lock_errors': dict(errors),
+                         'seconds': round(seconds, 3), 'submissions_per_second': round(len(submissions) / seconds, 1)}
+
+    with app.app_context():
+        report['invariants'] = check_invariants(n_members)
+        report['ok'] = report['contended_fixtures']['accepted'] == n_contested \
+                       and report['shared_members']['accepted'] == len(rest) \
+                       and all(v for k, v in report['invariants'].items() if k != 'games')
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-uri', default='sqlite:////tmp/chessleague_stress.db')
+    parser.add_argument('--members', type=int, default=12)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--contenders', type=int, default=4, help='Competing games submitted per contested fixture')
+    args = parser.parse_args()
+
+    print(json.dumps(run(args.database_uri, args.members, args.threads, args.contenders), indent=2))
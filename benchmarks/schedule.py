@@ -0,0 +1,49 @@
+import argparse
+import json
+import time
+from datetime import datetime
+
+from models import db, Event, Fixture
+import scheduler
+from benchmarks.synthetic import make_app, member_ids
+
+# Times Berger schedule generation and bulk fixture insertion for large events.
+#   python -m benchmarks.schedule --players 100 300 500 --cycles 2
+
+
+def run(database_uri, n_players, cycles):
+    app = make_app(database_uri)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+        start = time.perf_counter()
+        matchday, white, black = scheduler.round_robin(n_players, cycles)
+        generate_seconds = time.perf_counter() - start
+
+        event = Event(start_date=datetime.now(), start_timestamp=datetime.now(), active=True, n_rounds=4,
+                      rounds_duration=[7, 14, 21, 28], rounds_time_format=[{'base': 600, 'increment': 0}] * 4,
+                      players=member_ids(n_players))
+        db.session.add(event)
+        db.session.commit()
+
+        start = time.perf_counter()
+        created = scheduler.schedule_event(event, cycles=cycles)
+        schedule_seconds = time.perf_counter() - start
+
+        assert created == Fixture.query.count() == cycles * n_players * (n_players - 1) // 2
+
+    return {'players': n_players, 'cycles': cycles, 'fixtures': created,
+            'generate_seconds': round(generate_seconds, 4), 'schedule_and_insert_seconds': round(schedule_seconds, 3),
+            'fixtures_per_second': round(created / schedule_seconds)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-uri', default='sqlite://')
+    parser.add_argument('--players', type=int, nargs='+', default=[100, 300, 500])
+    parser.add_argument('--cycles', type=int, default=2)
+    args = parser.parse_args()
+
+    print(json.dumps([run(args.database_uri, n, args.cycles) for n in args.players], indent=2))
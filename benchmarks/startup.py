@@ -0,0 +1,51 @@
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Measures the cold start of a server worker: a fresh interpreter importing app and calling create_app.
+# Exits non-zero if the median is over budget or if a deferred dependency is imported on the cold path.
+#   python -m benchmarks.startup --runs 5 --budget 0.75
+
+DEFERRED_MODULES = ['requests', 'authlib', 'google.auth', 'google_jwt', 'lichess', 'importer', 'mock_db']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+created = time.perf_counter()
+print(json.dumps({'import_seconds': imported - start, 'create_app_seconds': created - imported,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+''' % DEFERRED_MODULES
+
+
+def probe():
+    output = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(n_runs, budget):
+    probes = [probe() for _ in range(n_runs)]
+    import_seconds = statistics.median(p['import_seconds'] for p in probes)
+    create_app_seconds = statistics.median(p['create_app_seconds'] for p in probes)
+    loaded = sorted({m for p in probes for m in p['loaded']})
+
+    return {'runs': n_runs, 'import_seconds': round(import_seconds, 3),
+            'create_app_seconds': round(create_app_seconds, 4),
+            'startup_seconds': round(import_seconds + create_app_seconds, 3), 'budget_seconds': budget,
+            'deferred_modules_loaded': loaded,
+            'ok': import_seconds + create_app_seconds <= budget and not loaded}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.75, help='Seconds allowed for import + create_app')
+    args = parser.parse_args()
+
+    result = run(args.runs, args.budget)
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result['ok'] else 1)
@@ -0,0 +1,168 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+import db_ops
+import response_cache
+from app import create_app
+from models import db, Fixture
+from benchmarks.synthetic import create_league, add_games, fixture_submissions, member_ids
+
+# Times the ranking, fixtures and game submission paths on synthetic leagues of several sizes, both at the
+# db_ops level and through the Flask test client. Results are JSON, so runs can be kept and compared:
+#   python -m benchmarks.suite --members 10 100 1000 --output before.json
+#   python -m benchmarks.suite --members 10 100 1000 --compare before.json
+# "cold" route timings clear the response cache before every request, "warm" ones are served from it.
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {'n': len(samples), 'min_ms': round(samples[0] * 1000, 3),
+            'median_ms': round(statistics.median(samples) * 1000, 3),
+            'p95_ms': round(samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1000, 3)}
+
+
+def timed(fn, repeat, before=None):
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+
+    return summarize(samples)
+
+
+def get_ok(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, f'{url} returned {response.status_code}'
+
+
+def open_fixtures(n):
+    return db.session.query(Fixture.id, Fixture.white, Fixture.black, Fixture.time_base, Fixture.time_increment) \
+                     .filter(Fixture.game_id.is_(None)).order_by(Fixture.id.desc()).limit(n).all()
+
+
+def run(database_uri, n_members, games_per_member, repeat):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'SQLALCHEMY_TRACK_MODIFICATIONS': False})
+    app.logger.setLevel(logging.WARNING)
+    client = app.test_client()
+    timings = {}
+
+    with app.app_context():
+        start = time.perf_counter()
+        event_id = create_league(n_members)
+        n_fixtures = Fixture.query.count()
+        n_games = len(add_games(min(games_per_member * n_members, n_fixtures // 2)))
+        setup_seconds = time.perf_counter() - start
+
+        player = member_ids(n_members)[0]
+        timings['db_ops.get_ranking_data'] = timed(lambda: db_ops.get_ranking_data(event_id), repeat)
+        timings['db_ops.get_fixtures'] = timed(db_ops.get_fixtures, repeat)
+        timings['db_ops.get_fixtures(page)'] = timed(lambda: db_ops.get_fixtures(limit=100, event_id=event_id), repeat)
+        timings['db_ops.get_fixtures(player)'] = timed(lambda: db_ops.get_fixtures(player=player), repeat)
+        timings['db_ops.get_crosstable'] = timed(lambda: db_ops.get_crosstable(event_id), repeat)
+
+        # The original single-game path, step by step, on fixtures nobody has played yet
+        submissions = iter(fixture_submissions(open_fixtures(repeat), seed=1, first_game=10 ** 7))
+        steps = {'validate_game': [], 'add_game_to_db': [], 'update_acl_elo': []}
+        for submission in submissions:
+            fixture_id, gamedata = submission['fixture_id'], submission['data']
+            start = time.perf_counter()
+            assert all(db_ops.validate_game(fixture_id, gamedata).values())
+            validated = time.perf_counter()
+            db_ops.add_game_to_db(fixture_id, gamedata)
+            added = time.perf_counter()
+            db_ops.update_acl_elo(fixture_id)
+            updated = time.perf_counter()
+
+            steps['validate_game'].append(validated - start)
+            steps['add_game_to_db'].append(added - validated)
+            steps['update_acl_elo'].append(updated - added)
+
+        timings.update({f'db_ops.{step}': summarize(samples) for step, samples in steps.items()})
+        timings['db_ops.submit_game'] = summarize([sum(samples) for samples in zip(*steps.values())])
+
+        submissions = iter(fixture_submissions(open_fixtures(repeat), seed=2, first_game=2 * 10 ** 7))
+
+    for name, url in [('ranking', '/ranking'), ('fixtures', '/fixtures'),
+                      ('fixtures(page)', f'/fixtures?event_id={event_id}&limit=100'),
+                      ('crosstable', f'/events/{event_id}/crosstable')]:
+        timings[f'GET {name} cold'] = timed(lambda: get_ok(client, url), repeat, before=response_cache.clear)
+        timings[f'GET {name} warm'] = timed(lambda: get_ok(client, url), repeat)
+
+    def post_game():
+        response = client.post('/game', data=json.dumps(next(submissions)))
+        assert all(response.get_json()['validation'].values())
+
+    timings['POST /game'] = timed(post_game, repeat)
+
+    return {'members': n_members, 'fixtures': n_fixtures, 'games': n_games,
+            'setup_seconds': round(setup_seconds, 2), 'timings': timings}
+
+
+def compare(baseline, results, tolerance, min_ms=1.0):
+    # Median-to-median ratios for every (members, timing) present in both runs. Slower by more than the tolerance
+    # (and by at least min_ms, so sub-millisecond noise doesn't count) is a regression
+    old = {(r['members'], name): t['median_ms'] for r in baseline['results'] for name, t in r['timings'].items()}
+    rows, regressions = [], 0
+    for result in results:
+        for name, timing in result['timings'].items():
+            before = old.get((result['members'], name))
+            if before is None:
+                continue
+
+            after = timing['median_ms']
+            regressed = after > before * (1 + tolerance) and after - before >= min_ms
+            regressions += regressed
+            rows.append(f'{result["members"]:>6} {name:<32} {before:>11.3f} {after:>11.3f} {after / max(before, 1e-9):>7.2f}x'
+                        + ('  REGRESSION' if regressed else ''))
+
+    print(f'{"members":>6} {"timing":<32} {"before_ms":>11} {"after_ms":>11} {"ratio":>8}', file=sys.stderr)
+    print('\n'.join(rows), file=sys.stderr)
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-uri', default='sqlite:///benchmark.db', help='Dropped and recreated per scale')
+    parser.add_argument('--members', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--games-per-member', type=int, default=10, help='Capped at half of the fixtures')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='Write the results here instead of stdout')
+    parser.add_argument('--compare', default=None, help='Results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before flagging (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    output = {'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'revision': git_revision(),
+                       'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__,
+                       'database_uri': args.database_uri, 'repeat': args.repeat},
+              'results': [run(args.database_uri, n, args.games_per_member, args.repeat) for n in args.members]}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            sys.exit(1 if compare(json.load(f), output['results'], args.tolerance) else 0)
@@ -0,0 +1,114 @@
+import random
+from datetime import datetime, timedelta
+from itertools import islice, permutations
+
+from flask import Flask
+
+import db_ops
+import scheduler
+from models import db, Event, Fixture, Member
+
+# Synthetic leagues for benchmarks. Nothing here talks to Lichess.
+
+MOVES = ('e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O h3 Nb8 d4 Nbd7 '
+         'c4 c6 cxb5 axb5 Nc3 Bb7 Bg5 b4 Nb1 h6 Bh4 c5 dxe5 Nxe4 Bxe7 Qxe7 exd6 Qf6').split()
+
+
+def make_app(database_uri='sqlite://'):
+    app = Flask('benchmarks')
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if database_uri.startswith('sqlite:///'):
+        # Let concurrent writers wait on the database lock instead of failing after 5s
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 60, 'check_same_thread': False}}
+    db.init_app(app)
+    return app
+
+
+def member_ids(n_members):
+    return [f'player{i:05d}' for i in range(n_members)]
+
+
+def create_league(n_members, n_rounds=1, time_format=(600, 0), start_date=None):
+    # Members, one active event and a full double round-robin per round, inserted in bulk
+    db.drop_all()
+    db.create_all()
+
+    start_date = start_date or datetime.now()
+    members = member_ids(n_members)
+    db.session.bulk_insert_mappings(Member, [{'lichess_id': m, 'acl_username': m, 'lichess_username': m,
+                                              'acl_elo': 1000, 'date_joined': start_date} for m in members])
+
+    base, increment = time_format
+    event = Event(start_date=start_date, start_timestamp=start_date, active=True, n_rounds=n_rounds,
+                  rounds_duration=[30] * n_rounds, rounds_time_format=[{'base': base, 'increment': increment}] * n_rounds,
+                  playoffs_method={'top': 2}, players=members)
+    db.session.add(event)
+    db.session.flush()
+
+    deadline = (start_date + timedelta(30 * n_rounds)).date()
+    rows = ({'round_number': r, 'event_id': event.id, 'white': w, 'black': b,
+             'deadline': deadline, 'time_base': base, 'time_increment': increment}
+            for r in range(1, n_rounds + 1) for w, b in permutations(members, 2))
+    for batch in iter(lambda: list(islice(rows, scheduler.INSERT_BATCH_SIZE)), []):
+        db.session.execute(Fixture.__table__.insert(), batch)
+    db.session.commit()
+
+    db_ops.rebuild_standings(event.id)
+    return event.id
+
+
+def lichess_gamedata(game_id, white, black, outcome, created_at, time_format=(600, 0), rng=random):
+    # Shaped like a lichess game export, moves and clocks included, so payload sizes are realistic
+    base, increment = time_format
+    n_plies = rng.randint(20, 120)
+    gamedata = {
+        'id': game_id,
+        'rated': True,
+        'variant': 'standard',
+        'speed': 'rapid' if base >= 480 else 'blitz',
+        'perf': 'rapid' if base >= 480 else 'blitz',
+        'createdAt': int(created_at.timestamp() * 1000),
+        'lastMoveAt': int((created_at + timedelta(seconds=n_plies * 10)).timestamp() * 1000),
+        'status': 'draw' if outcome == 'draw' else rng.choice(['mate', 'resign', 'outoftime']),
+        'players': {
+            'white': {'user': {'name': white, 'id': white}, 'rating': rng.randint(800, 2200), 'ratingDiff': rng.randint(-8, 8)},
+            'black': {'user': {'name': black, 'id': black}, 'rating': rng.randint(800, 2200), 'ratingDiff': rng.randint(-8, 8)},
+        },
+        'opening': {'eco': 'C95', 'name': 'Ruy Lopez: Morphy Defense, Breyer Defense', 'ply': 19},
+        'moves': ' '.join(rng.choice(MOVES) for _ in range(n_plies)),
+        'clocks': [base * 100 - i * 150 for i in range(n_plies)],
+        'clock': {'initial': base, 'increment': increment, 'totalTime': base + 40 * increment},
+    }
+    if outcome != 'draw':
+        gamedata['winner'] = outcome
+
+    return gamedata
+
+
+def fixture_submissions(fixtures, start_date=None, seed=0, first_game=0):
+    # One valid {'fixture_id', 'data'} submission per fixture, in the format POST /game expects. Game ids are
+    # numbered from first_game, so separate batches for the same database don't collide
+    rng = random.Random(seed)
+    start_date = start_date or datetime.now()
+
+    return [{'fixture_id': f.id,
+             'data': lichess_gamedata(f'{first_game + i:08d}', f.white, f.black, rng.choice(['white', 'black', 'draw']),
+                                      start_date + timedelta(seconds=i), (f.time_base, f.time_increment), rng)}
+            for i, f in enumerate(fixtures)]
+
+
+def add_games(n_games, start_date=None, seed=0):
+    # Plays n_games randomly chosen fixtures through the batch submission path. Returns the accepted game ids
+    rng = random.Random(seed)
+    fixture_ids = [fixture_id for fixture_id, in db.session.query(Fixture.id).filter(Fixture.game_id.is_(None))]
+    chosen = sorted(rng.sample(fixture_ids, min(n_games, len(fixture_ids))))
+
+    fixtures = []
+    for start in range(0, len(chosen), 900):  # Stay under SQLite's bound parameter limit
+        fixtures += db.session.query(Fixture.id, Fixture.white, Fixture.black, Fixture.time_base, Fixture.time_increment) \
+                              .filter(Fixture.id.in_(chosen[start:start + 900])).all()
+
+    _, accepted = db_ops.validate_games(fixture_submissions(fixtures, start_date, seed))
+    added, _ = db_ops.add_games_to_db(accepted)
+    return added
@@ -0,0 +1,89 @@
+import numpy as np
+
+# Head-to-head matrices for an event, built from all its games at once. Entry [i, j] is always from the point of
+# view of member i against member j. Tiebreaks are computed for all members at once from the same matrices.
+
+TIEBREAKS = ('direct_encounter', 'wins', 'sonneborn_berger', 'buchholz')
+DEFAULT_TIEBREAK_ORDER = list(TIEBREAKS)
+
+
+def score_matrices(white_idx, black_idx, white_score, n_members):
+    # Counts are accumulated with bincount over the flattened (i, j) index, so cost is linear in games
+    as_white = white_idx * n_members + black_idx
+    as_black = black_idx * n_members + white_idx
+    size = n_members * n_members
+
+    white_games = np.bincount(as_white, minlength=size).reshape(n_members, n_members)
+    white_points = np.bincount(as_white, weights=white_score, minlength=size).reshape(n_members, n_members)
+    black_points = np.bincount(as_black, weights=1 - white_score, minlength=size).reshape(n_members, n_members)
+    white_wins = np.bincount(as_white, weights=white_score == 1, minlength=size).reshape(n_members, n_members)
+    black_wins = np.bincount(as_black, weights=white_score == 0, minlength=size).reshape(n_members, n_members)
+
+    return {'points': white_points + black_points,
+            'games': white_games + white_games.T,
+            'wins': (white_wins + black_wins).astype(np.int64),
+            'white_games': white_games,  # Games i played with white against j
+            'white_points': white_points}
+
+
+def tiebreak_keys(matrices, tiebreak_order=DEFAULT_TIEBREAK_ORDER):
+    # Points and each tiebreak of tiebreak_order, as one array per key:
+    # - direct_encounter: points scored against the members level with you on every earlier key
+    # - wins: games won
+    # - sonneborn_berger: sum of the final points of each opponent times your score against them
+    # - buchholz: sum of the final points of each opponent, once per game played against them
+    points = matrices['points'].sum(axis=1)
+    keys = {'points': points}
+
+    for name in tiebreak_order:
+        if name == 'direct_encounter':
+            # Members level on all keys so far share a group, and only points scored inside the group count
+            _, group = np.unique(np.column_stack(list(keys.values())), axis=0, return_inverse=True)
+            group = group.ravel()
+            keys[name] = (matrices['points'] * (group[:, None] == group[None, :])).sum(axis=1)
+        elif name == 'wins':
+            keys[name] = matrices['wins'].sum(axis=1)
+        elif name == 'sonneborn_berger':
+            keys[name] = matrices['points'] @ points
+        elif name == 'buchholz':
+            keys[name] = matrices['games'] @ points
+        else:
+            raise ValueError(f'Unknown tiebreak {name}. Expected one of {", ".join(TIEBREAKS)}')
+
+    return keys
+
+
+def rank(keys):
+    # One lexicographic sort, highest first on points then on each tiebreak in order. Members level on every key
+    # keep their input order
+    return np.lexsort([-values for values in reversed(list(keys.values()))])
+
+
+def standings_order(matrices, tiebreak_order=DEFAULT_TIEBREAK_ORDER):
+    return rank(tiebreak_keys(matrices, tiebreak_order))
+
+
+def reorder(matrices, order):
+    return {name: matrix[np.ix_(order, order)] for name, matrix in matrices.items()}
+
+
+if __name__ == '__main__':
+    import time
+
+    # Full double round-robin of n members
+    for n in [10, 100, 500]:
+        rng = np.random.default_rng(0)
+        white_idx, black_idx = (a.ravel() for a in np.meshgrid(np.arange(n), np.arange(n), indexing='ij'))
+        played = white_idx != black_idx
+        white_idx, black_idx = white_idx[played], black_idx[played]
+        white_score = rng.choice([0, 0.5, 1], size=len(white_idx))
+
+        start = time.perf_counter()
+        matrices = score_matrices(white_idx, black_idx, white_score, n)
+        matrices = reorder(matrices, standings_order(matrices))
+        seconds = time.perf_counter() - start
+
+        assert matrices['points'].sum() == len(white_idx)
+        assert (matrices['points'] + matrices['points'].T == matrices['games']).all()
+        assert (matrices['wins'] <= matrices['points']).all()
+        print(f'{n} members, {len(white_idx)} games: {seconds * 1000:.2f}ms')
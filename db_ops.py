@@ -1,6 +1,15 @@
-from models import Member, User, Event, Game, Fixture, db
+from models import Member, User, Event, Game, GameExport, Fixture, Standing, RatingChange, db
 from datetime import datetime
-from elo import get_rating_deltas
+from elo import get_rating_deltas, encode_games, EloReplay, K_FACTOR, INITIAL_RATING, RESULT_MAPPING
+import crosstable
+import glicko2
+import live_updates
+import projections
+import user_cache
+import numpy as np
+from sqlalchemy import and_, case, column, func, inspect, or_, select, table, union_all
+from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.exc import IntegrityError
 import sys
 import logging
 
@@ -10,6 +19,7 @@ def create_user(**kwargs):
     new_user = User(**kwargs)
     db.session.add(new_user)
     db.session.commit()
+    user_cache.invalidate(new_user.id)
     logger.info(f'New user {new_user} added to database')
     return new_user
 
@@ -30,17 +40,23 @@ def update_user_lichess_data(user_id, lichess_data):
     user.lichess_blitz_elo = lichess_data['perfs']['blitz']['rating']
 
     db.session.commit()
+    user_cache.invalidate(user_id)
 
 
 def validate_game(fixture_id, lichess_gamedata):
-    # Check if fixture has already been fulfilled
     fixture = Fixture.query.get(fixture_id)
-    
-    not_fulfilled = not bool(fixture.game_id)
 
     # Check if game is already uploaded
     new_game = not bool(Game.query.get(lichess_gamedata['id']))
-    
+
+    return check_game(fixture, lichess_gamedata, new_game)
+
+
+def check_game(fixture, lichess_gamedata, new_game):
+    # Validation rules on an already loaded fixture, so callers can batch the lookups
+    # Check if fixture has already been fulfilled
+    not_fulfilled = not bool(fixture.game_id)
+
     # Check if users are in current event
     valid_members = lichess_gamedata['players']['white']['user']['id'] == fixture.white \
                     and  lichess_gamedata['players']['black']['user']['id'] == fixture.black
@@ -52,46 +68,67 @@ def validate_game(fixture_id, lichess_gamedata):
     
     # Check if correct time format was used
     correct_time_format = fixture.time_base == time_base and fixture.time_increment == time_increment
+
+    # Check if the event is still open. Closed events have frozen standings
+    event_open = fixture.event.closed_at is None
     
     validation_data = {}
-    for k, v in zip(['not_fulfilled', 'valid_members', 'new_game', 'within_deadline', 'correct_time_format'], 
-                    [not_fulfilled, valid_members, new_game, within_deadline, correct_time_format]):
+    for k, v in zip(['not_fulfilled', 'valid_members', 'new_game', 'within_deadline', 'correct_time_format', 'event_open'], 
+                    [not_fulfilled, valid_members, new_game, within_deadline, correct_time_format, event_open]):
         validation_data[k] = v
 
     return validation_data
 
 
+def parse_game(lichess_gamedata, event_id):
+    # Parse lichess_gamedata into the column values of a Game row
+    outcome = lichess_gamedata['winner'] if 'winner' in lichess_gamedata else 'draw'
+
+    return {'id': lichess_gamedata['id'],
+            'date_played': datetime.utcfromtimestamp(lichess_gamedata['createdAt'] * 1e-3),
+            'date_added': datetime.now(),
+            'white': lichess_gamedata['players']['white']['user']['id'],
+            'black': lichess_gamedata['players']['black']['user']['id'],
+            'outcome': outcome,
+            'winner': lichess_gamedata['players'][outcome]['user']['id'] if outcome != 'draw' else None,
+            'time_base': lichess_gamedata['clock']['initial'],
+            'time_increment': lichess_gamedata['clock']['increment'],
+            'event_id': event_id,
+            }
+
+
 def add_game_to_db(fixture_id, lichess_gamedata):
     # Function will be called only after validation
     fixture = Fixture.query.get(fixture_id)
 
-    # Parse lichess_gamedata and build Game row to add to the database
-    date_played = datetime.utcfromtimestamp(lichess_gamedata['createdAt'] * 1e-3)
-    outcome = lichess_gamedata['winner'] if 'winner' in lichess_gamedata else 'draw'
-    white = lichess_gamedata['players']['white']['user']['id']
-    black = lichess_gamedata['players']['black']['user']['id']
-    winner = lichess_gamedata['players'][outcome]['user']['id'] if outcome != 'draw' else None
-
-    game = Game(id=lichess_gamedata['id'],
-                lichess_gamedata=lichess_gamedata,
-                date_played=date_played,
-                date_added=datetime.now(),
-                white=white,
-                black=black,
-                outcome=outcome,
-                winner=winner,
-                time_base=lichess_gamedata['clock']['initial'],
-                time_increment=lichess_gamedata['clock']['increment'],
-                event_id=fixture.event_id,
-                )
+    game = Game(**parse_game(lichess_gamedata, fixture.event_id))
+    white, black, outcome = game.white, game.black, game.outcome
 
     fixture.game_id = game.id
     fixture.outcome = outcome
 
+    # Keep the materialized standings in step with the accepted game
+    _count_result(fixture.event_id, white, black, outcome)
+
+    _bump_data_version(fixture.event_id)
+
     db.session.add(game)
+    db.session.add(GameExport(game_id=game.id, lichess_gamedata=lichess_gamedata))
     db.session.commit()
 
 
+def _count_result(event_id, white, black, outcome):
+    for member_id, side in [(white, 'white'), (black, 'black')]:
+        standing = _get_standing(member_id, event_id)
+        standing.games_played += 1
+        if outcome == 'draw':
+            standing.draws += 1
+        elif outcome == side:
+            standing.wins += 1
+        else:
+            standing.losses += 1
+
+
 def update_acl_elo(fixture_id):
     fixture = Fixture.query.get(fixture_id)
     game = Game.query.get(fixture.game_id)
@@ -100,49 +137,708 @@ def update_acl_elo(fixture_id):
     black = Member.query.get(game.black)
     white_delta, black_delta = get_rating_deltas(white.acl_elo, black.acl_elo, game.outcome)
 
+    db.session.bulk_insert_mappings(RatingChange, _rating_changes(game.id, game.event_id, game.date_played,
+                                                                  (white.lichess_id, white.acl_elo, white_delta),
+                                                                  (black.lichess_id, black.acl_elo, black_delta)))
+
     new_white_elo, new_black_elo = white.acl_elo + white_delta, black.acl_elo + black_delta
     white.acl_elo = new_white_elo
     black.acl_elo = new_black_elo
 
+    # Glicko-2 events only get their standings rating when the round is rated (see rate_glicko2_round)
+    if fixture.event.rating_system != 'glicko2':
+        _get_standing(white.lichess_id, fixture.event_id).rating = new_white_elo
+        _get_standing(black.lichess_id, fixture.event_id).rating = new_black_elo
+
+    _bump_data_version(fixture.event_id)
+    _publish_game(fixture, game.id, game.outcome)
+
+    db.session.commit()
+
+
+def _publish_game(fixture, game_id, outcome):
+    # Delta for /stream subscribers, sent once the game's transaction commits (see live_updates).
+    # Both standings are already in the session, so this only reads the event's new data version
+    delta = _game_delta(fixture, game_id, outcome)
+    delta['version'] = db.session.query(Event.data_version).filter_by(id=fixture.event_id).scalar()
+    live_updates.publish_after_commit(delta)
+
+
+def _game_delta(fixture, game_id, outcome):
+    # Fixture and both members' standings as they are right after the game, without the event's data version
+    members = []
+    for member_id in [fixture.white, fixture.black]:
+        standing = _get_standing(member_id, fixture.event_id)
+        members.append({'id': member_id, 'wins': standing.wins, 'draws': standing.draws, 'losses': standing.losses,
+                        'games_played': standing.games_played, 'aelo': standing.rating})
+
+    return {'event_id': fixture.event_id, 'version': None,
+            'fixture': {'id': fixture.id, 'round_number': fixture.round_number,
+                        'white': fixture.white, 'black': fixture.black, 'game_id': game_id, 'outcome': outcome},
+            'members': members}
+
+
+def accept_game(fixture_id, lichess_gamedata, commit=True):
+    # validate_game + add_game_to_db + update_acl_elo as one transaction that is safe under concurrent submissions.
+    # Returns the validation data; the game was stored only if every check passed. With commit=False an accepted
+    # game is left in the open transaction, for callers that record something alongside it (see ingest_queue)
+    fixture = Fixture.query.with_for_update().get(fixture_id)
+    if fixture is None:
+        db.session.rollback()
+        return {'fixture_found': False}
+
+    validation_data = check_game(fixture, lichess_gamedata, new_game=Game.query.get(lichess_gamedata['id']) is None)
+    if not all(validation_data.values()):
+        db.session.rollback()
+        return validation_data
+
+    game = parse_game(lichess_gamedata, fixture.event_id)
+
+    # Claim the fixture with a conditional update. This is what stops a concurrent submission from filling it
+    # twice on databases that ignore FOR UPDATE (SQLite), and it takes the write lock before any rating is read.
+    claimed = Fixture.query.filter(Fixture.id == fixture_id, Fixture.game_id.is_(None)) \
+                           .update({Fixture.game_id: game['id'], Fixture.outcome: game['outcome']},
+                                   synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        validation_data['not_fulfilled'] = False
+        return validation_data
+
+    # Lock both members in a fixed order so two games sharing a player serialize instead of deadlocking,
+    # and re-read them so the Elo update starts from the latest committed ratings
+    players = sorted([game['white'], game['black']])
+    members = {m.lichess_id: m for m in Member.query.filter(Member.lichess_id.in_(players))
+                                                    .order_by(Member.lichess_id)
+                                                    .with_for_update().populate_existing()}
+    standings = Standing.query.filter(Standing.event_id == fixture.event_id, Standing.member_id.in_(players)) \
+                              .with_for_update().populate_existing().all()
+
+    db.session.add(Game(**game))
+    db.session.add(GameExport(game_id=game['id'], lichess_gamedata=lichess_gamedata))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        # Same game submitted concurrently for another fixture
+        db.session.rollback()
+        validation_data['new_game'] = False
+        return validation_data
+
+    _count_result(fixture.event_id, game['white'], game['black'], game['outcome'])
+
+    white, black = members[game['white']], members[game['black']]
+    white_delta, black_delta = get_rating_deltas(white.acl_elo, black.acl_elo, game['outcome'])
+    db.session.bulk_insert_mappings(RatingChange, _rating_changes(game['id'], game['event_id'], game['date_played'],
+                                                                  (white.lichess_id, white.acl_elo, white_delta),
+                                                                  (black.lichess_id, black.acl_elo, black_delta)))
+    white.acl_elo, black.acl_elo = white.acl_elo + white_delta, black.acl_elo + black_delta
+
+    if fixture.event.rating_system != 'glicko2':
+        _get_standing(white.lichess_id, fixture.event_id).rating = white.acl_elo
+        _get_standing(black.lichess_id, fixture.event_id).rating = black.acl_elo
+
+    _bump_data_version(fixture.event_id)
+    _publish_game(fixture, game['id'], game['outcome'])
+
+    if commit:
+        db.session.commit()
+    return validation_data
+
+
+def get_game_export(game_id):
+    # The raw lichess export is only loaded here, never by ranking or fixture queries
+    export = GameExport.query.get(game_id)
+    return export.lichess_gamedata if export else None
+
+
+def migrate_game_exports(batch_size=1000):
+    # One-off migration for databases created while games.lichess_gamedata was a JSON column: copies the payloads
+    # into game_exports (compressed) and drops the old column
+    if 'lichess_gamedata' not in {c['name'] for c in inspect(db.engine).get_columns('games')}:
+        logger.info('games.lichess_gamedata is already gone. Nothing to migrate')
+        return 0
+
+    GameExport.__table__.create(db.engine, checkfirst=True)
+    old_games = table('games', column('id', db.String), column('lichess_gamedata', JSON))
+
+    # Keyset batches over games.id, each committed, so only one batch of payloads is in memory at a time and an
+    # interrupted run picks up where it stopped (exports already copied are skipped)
+    copied, last_id = 0, ''
+    while True:
+        rows = db.session.execute(select([old_games.c.id, old_games.c.lichess_gamedata])
+                                  .where(and_(old_games.c.id > last_id, old_games.c.lichess_gamedata.isnot(None)))
+                                  .order_by(old_games.c.id).limit(batch_size)).fetchall()
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        migrated = {game_id for game_id, in db.session.query(GameExport.game_id)
+                                                      .filter(GameExport.game_id.in_([game_id for game_id, _ in rows]))}
+        to_copy = [{'game_id': game_id, 'lichess_gamedata': gamedata} for game_id, gamedata in rows if game_id not in migrated]
+        db.session.bulk_insert_mappings(GameExport, to_copy)
+        db.session.commit()
+
+        copied += len(to_copy)
+        logger.info(f'Migrated {copied} game exports (up to game {last_id})')
+
+    db.session.execute('ALTER TABLE games DROP COLUMN lichess_gamedata')
+    db.session.commit()
+    return copied
+
+
+def validate_games(submissions):
+    # Set-based validate_game for a list of {'fixture_id', 'data'} submissions: one fixtures query and one
+    # games query for the whole batch. A fixture or game used twice in the batch is only valid the first time.
+    fixture_ids = [s['fixture_id'] for s in submissions]
+    game_ids = [s['data']['id'] for s in submissions]
+
+    fixtures = {f.id: f for f in Fixture.query.filter(Fixture.id.in_(fixture_ids))}
+    taken_games = {game_id for game_id, in db.session.query(Game.id).filter(Game.id.in_(game_ids))}
+    taken_fixtures = set()
+
+    validations, accepted = [], []
+    for submission in submissions:
+        fixture = fixtures.get(submission['fixture_id'])
+        if fixture is None:
+            validations.append({'fixture_found': False})
+            continue
+
+        validation_data = check_game(fixture, submission['data'], new_game=submission['data']['id'] not in taken_games)
+        validation_data['not_fulfilled'] = validation_data['not_fulfilled'] and fixture.id not in taken_fixtures
+        validations.append(validation_data)
+
+        if all(validation_data.values()):
+            taken_fixtures.add(fixture.id)
+            taken_games.add(submission['data']['id'])
+            accepted.append((fixture, submission['data']))
+
+    return validations, accepted
+
+
+def add_games_to_db(accepted, chunk_size=150):
+    # Bulk version of accept_game for validated (fixture, lichess_gamedata) pairs, with the same guarantees under
+    # concurrent submissions. Everything is written in a single transaction, with Elo applied in chronological order.
+    # Returns (accepted game ids, {game_id: failed checks} for pairs that lost a race since they were validated)
+    if not accepted:
+        return [], {}
+
+    accepted = sorted(accepted, key=lambda pair: pair[1]['createdAt'])
+    games = {gamedata['id']: parse_game(gamedata, fixture.event_id) for fixture, gamedata in accepted}
+    exports = {gamedata['id']: gamedata for _, gamedata in accepted}
+    fixture_games = {fixture.id: gamedata['id'] for fixture, gamedata in accepted}
+    lost = {}
+
+    # Claim the fixtures with accept_game's conditional update, one statement per chunk. Reading them back shows
+    # which ones are ours: a fixture filled concurrently keeps the other game
+    claimed = {}
+    fixture_ids = list(fixture_games)
+    for start in range(0, len(fixture_ids), chunk_size):
+        chunk = {fixture_id: fixture_games[fixture_id] for fixture_id in fixture_ids[start:start + chunk_size]}
+        Fixture.query.filter(Fixture.id.in_(list(chunk)), Fixture.game_id.is_(None)) \
+                     .update({Fixture.game_id: case(chunk, value=Fixture.id),
+                              Fixture.outcome: case({f: games[g]['outcome'] for f, g in chunk.items()}, value=Fixture.id)},
+                             synchronize_session=False)
+        for fixture_id, game_id in db.session.query(Fixture.id, Fixture.game_id).filter(Fixture.id.in_(list(chunk))):
+            if game_id == chunk[fixture_id]:
+                claimed[fixture_id] = game_id
+            else:
+                lost[chunk[fixture_id]] = {'not_fulfilled': False}
+
+    for fixture, _ in accepted:
+        db.session.expire(fixture, ['game_id', 'outcome'])
+
+    # Lock every member in a fixed order, as accept_game does, and rate from the latest committed ratings
+    games = {game_id: game for game_id, game in games.items() if game_id not in lost}
+    player_ids = sorted({game['white'] for game in games.values()} | {game['black'] for game in games.values()})
+    members = {m.lichess_id: m for m in Member.query.filter(Member.lichess_id.in_(player_ids))
+                                                    .order_by(Member.lichess_id)
+                                                    .with_for_update().populate_existing()}
+    event_ids = sorted({game['event_id'] for game in games.values()})
+    events = {e.id: e for e in Event.query.filter(Event.id.in_(event_ids))}
+    Standing.query.filter(Standing.event_id.in_(event_ids), Standing.member_id.in_(player_ids)) \
+                  .order_by(Standing.event_id, Standing.member_id).with_for_update().populate_existing().all()
+
+    # A game stored concurrently (for another fixture) fails the whole insert. Then insert them one by one and give
+    # back the fixtures of the duplicates
+    try:
+        with db.session.begin_nested():
+            db.session.bulk_insert_mappings(Game, list(games.values()))
+            db.session.bulk_insert_mappings(GameExport, [{'game_id': g, 'lichess_gamedata': exports[g]} for g in games])
+    except IntegrityError:
+        for game_id, game in list(games.items()):
+            try:
+                with db.session.begin_nested():
+                    db.session.bulk_insert_mappings(Game, [game])
+                    db.session.bulk_insert_mappings(GameExport, [{'game_id': game_id, 'lichess_gamedata': exports[game_id]}])
+            except IntegrityError:
+                lost[game_id] = {'new_game': False}
+                del games[game_id]
+                Fixture.query.filter(Fixture.game_id == game_id, Fixture.id.in_(list(claimed))) \
+                             .update({Fixture.game_id: None, Fixture.outcome: None}, synchronize_session=False)
+
+    fixtures = {gamedata['id']: fixture for fixture, gamedata in accepted}
+    rating_changes, deltas = [], []
+    for game in games.values():
+        white, black = members[game['white']], members[game['black']]
+        white_delta, black_delta = get_rating_deltas(white.acl_elo, black.acl_elo, game['outcome'])
+        rating_changes += _rating_changes(game['id'], game['event_id'], game['date_played'],
+                                          (white.lichess_id, white.acl_elo, white_delta),
+                                          (black.lichess_id, black.acl_elo, black_delta))
+        white.acl_elo, black.acl_elo = white.acl_elo + white_delta, black.acl_elo + black_delta
+
+        _count_result(game['event_id'], white.lichess_id, black.lichess_id, game['outcome'])
+        if events[game['event_id']].rating_system != 'glicko2':
+            _get_standing(white.lichess_id, game['event_id']).rating = white.acl_elo
+            _get_standing(black.lichess_id, game['event_id']).rating = black.acl_elo
+        deltas.append(_game_delta(fixtures[game['id']], game['id'], game['outcome']))
+
+    db.session.bulk_insert_mappings(RatingChange, rating_changes)
+
+    for event_id in {game['event_id'] for game in games.values()}:
+        _bump_data_version(event_id)
+
+    # One /stream delta per game, as accept_game sends, all carrying the event's version after the batch
+    versions = dict(db.session.query(Event.id, Event.data_version).filter(Event.id.in_(event_ids)))
+    for delta in deltas:
+        delta['version'] = versions[delta['event_id']]
+        live_updates.publish_after_commit(delta)
+
+    db.session.commit()
+    if lost:
+        logger.warning(f'{len(lost)} games lost a race to concurrent submissions: {lost}')
+    return list(games), lost
+
+
+def _rating_changes(game_id, event_id, date_played, *changes):
+    # rating_history rows for one game. changes are (member_id, rating_before, delta) tuples.
+    # History is served by day, so only the date of the game's start time is kept
+    if isinstance(date_played, datetime):
+        date_played = date_played.date()
+    return [{'member_id': member_id, 'game_id': game_id, 'event_id': event_id, 'date_played': date_played,
+             'rating_before': rating_before, 'rating_after': rating_before + delta, 'delta': delta}
+            for member_id, rating_before, delta in changes]
+
+
+def rate_glicko2_round(event_id, round_number):
+    # A round of a Glicko-2 event is one rating period: all its games are rated at once
+    event = Event.query.get(event_id)
+    if event.rating_system != 'glicko2':
+        raise ValueError(f'Event {event_id} is not rated with Glicko-2')
+
+    next_round = (event.last_rated_round or 0) + 1
+    if round_number != next_round:
+        raise ValueError(f'Rounds of event {event_id} are rated in order: the next one to rate is round {next_round}')
+
+    games = db.session.query(Game.white, Game.black, Game.outcome) \
+                      .join(Fixture, Fixture.game_id == Game.id) \
+                      .filter(Fixture.event_id == event_id, Fixture.round_number == round_number).all()
+
+    standings = Standing.query.filter_by(event_id=event_id).order_by(Standing.member_id).all()
+    member_ids = [s.member_id for s in standings]
+    member_index = {m: i for i, m in enumerate(member_ids)}
+    members = {m.lichess_id: m for m in Member.query.filter(Member.lichess_id.in_(member_ids))}
+    players = [members[member_id] for member_id in member_ids]  # Aligned with member_index
+
+    logger.info(f'Rating round {round_number} of event {event_id}: {len(games)} games, {len(members)} members')
+
+    ratings, rds, volatilities = glicko2.rate_period(
+        [p.glicko_rating or glicko2.INITIAL_RATING for p in players],
+        [p.glicko_rd or glicko2.INITIAL_RD for p in players],
+        [p.glicko_volatility or glicko2.INITIAL_VOLATILITY for p in players],
+        np.array([member_index[g.white] for g in games], dtype=np.int64),
+        np.array([member_index[g.black] for g in games], dtype=np.int64),
+        np.array([RESULT_MAPPING[g.outcome][0] for g in games], dtype=np.float64),
+    )
+
+    for standing in standings:
+        i = member_index[standing.member_id]
+        member = members[standing.member_id]
+        member.glicko_rating, member.glicko_rd = float(ratings[i]), float(rds[i])
+        member.glicko_volatility = float(volatilities[i])
+        standing.rating = float(ratings[i])
+
+    event.last_rated_round = round_number
+    _bump_data_version(event_id)
+    db.session.commit()
+
+
+def recompute_ratings(k_factor=K_FACTOR, initial_rating=INITIAL_RATING):
+    # Replays every game in the order it was played and rewrites all ratings and the rating history.
+    # Games are ordered by their full lichess start time, so games played on the same day keep their real order
+    # instead of falling back to their (random) lichess id
+    logger.info('Recomputing ratings...')
+
+    games = db.session.query(Game.id, Game.white, Game.black, Game.outcome, Game.date_played, Game.event_id) \
+                      .order_by(Game.date_played, Game.date_added, Game.id).all()
+    member_ids = [member_id for member_id, in db.session.query(Member.lichess_id).order_by(Member.lichess_id)]
+
+    replay = EloReplay(member_ids, k_factor=k_factor, initial_rating=initial_rating)
+    ratings = replay.replay([(g.white, g.black, g.outcome) for g in games], record_history=True)
+    _rewrite_rating_history(games, *replay.history)
+
+    db.session.bulk_update_mappings(Member, [{'lichess_id': m, 'acl_elo': r} for m, r in ratings.items()])
+    db.session.flush()
+
+    member_rating = select([Member.acl_elo]).where(Member.lichess_id == Standing.member_id).as_scalar()
+    elo_events = select([Event.id]).where(func.coalesce(Event.rating_system, 'elo') != 'glicko2') \
+                                   .where(Event.closed_at.is_(None))
+    db.session.execute(Standing.__table__.update().where(Standing.event_id.in_(elo_events)).values(rating=member_rating))
+
+    Event.query.update({Event.data_version: func.coalesce(Event.data_version, 0) + 1}, synchronize_session=False)
+    db.session.commit()
+
+
+def _rewrite_rating_history(games, white_before, black_before, white_delta):
+    # Replaces all rating_history rows with the replay's before/delta values of games (ordered as replayed)
+    RatingChange.query.delete(synchronize_session=False)
+
+    rows = []
+    for g, white_rating, black_rating, delta in zip(games, white_before.tolist(), black_before.tolist(),
+                                                    white_delta.tolist()):
+        rows += _rating_changes(g.id, g.event_id, g.date_played, (g.white, white_rating, delta),
+                                (g.black, black_rating, -delta))
+
+    for start in range(0, len(rows), 10000):
+        db.session.execute(RatingChange.__table__.insert(), rows[start:start + 10000])
+
+
+def get_rating_history(member_id, date_from=None, date_to=None, max_points=None):
+    # A member's rating after each game, oldest first. Above max_points, consecutive games are merged into
+    # max_points buckets: each point is the rating after the bucket's last game, with the bucket's low and high
+    query = db.session.query(RatingChange.date_played, RatingChange.game_id, RatingChange.rating_before,
+                             RatingChange.rating_after, RatingChange.delta) \
+                      .filter(RatingChange.member_id == member_id) \
+                      .order_by(RatingChange.date_played, RatingChange.id)
+    if date_from is not None:
+        query = query.filter(RatingChange.date_played >= date_from)
+    if date_to is not None:
+        query = query.filter(RatingChange.date_played <= date_to)
+
+    rows = query.all()
+    if max_points is None or len(rows) <= max_points:
+        return [{'date': r.date_played, 'game_id': r.game_id, 'rating': r.rating_after, 'delta': r.delta}
+                for r in rows]
+
+    points = []
+    edges = np.linspace(0, len(rows), max_points + 1).astype(np.int64).tolist()
+    for start, end in zip(edges[:-1], edges[1:]):
+        bucket = rows[start:end]
+        ratings = [bucket[0].rating_before] + [r.rating_after for r in bucket]
+        points.append({'date': bucket[-1].date_played, 'game_id': bucket[-1].game_id, 'rating': bucket[-1].rating_after,
+                       'delta': bucket[-1].rating_after - bucket[0].rating_before, 'low': min(ratings),
+                       'high': max(ratings), 'games': len(bucket)})
+
+    return points
+
+
+def _bump_data_version(event_id):
+    # Done in SQL so concurrent writers (other workers included) never lose a bump
+    Event.query.filter_by(id=event_id).update({Event.data_version: func.coalesce(Event.data_version, 0) + 1},
+                                              synchronize_session=False)
+
+
+def get_data_version(event_id=None):
+    # Version of a single event, or of the whole league when event_id is None
+    if event_id is not None:
+        return db.session.query(Event.data_version).filter_by(id=event_id).scalar()
+
+    return tuple(db.session.query(Event.id, Event.data_version).order_by(Event.id))
+
+
+def _get_standing(member_id, event_id):
+    standing = Standing.query.get((member_id, event_id))
+
+    if standing is None:
+        # Only reached when standings were never built for this event. Start it from the stored data
+        logger.warning(f'Missing standing for {member_id} in event {event_id}. Creating it')
+        games_required = _games_required_by_member(event_id).get(member_id, 0)
+        member = Member.query.get(member_id)
+        standing = Standing(member_id=member_id, event_id=event_id, wins=0, draws=0, losses=0, games_played=0,
+                            games_required=games_required, rating=member.acl_elo if member else None)
+        db.session.add(standing)
+
+    return standing
+
+
+def _game_results_by_member(event_id=None):
+    # One row per (member, game) from both sides of the board, so a single GROUP BY counts everything
+    as_white = select([Game.white.label('member_id'),
+                       case([(Game.outcome == 'white', 1)], else_=0).label('win'),
+                       case([(Game.outcome == 'draw', 1)], else_=0).label('draw')])
+    as_black = select([Game.black.label('member_id'),
+                       case([(Game.outcome == 'black', 1)], else_=0).label('win'),
+                       case([(Game.outcome == 'draw', 1)], else_=0).label('draw')])
+
+    if event_id is not None:
+        as_white = as_white.where(Game.event_id == event_id)
+        as_black = as_black.where(Game.event_id == event_id)
+
+    sides = union_all(as_white, as_black).alias('game_sides')
+
+    rows = db.session.query(sides.c.member_id,
+                            func.count().label('games_played'),
+                            func.sum(sides.c.win).label('wins'),
+                            func.sum(sides.c.draw).label('draws')).group_by(sides.c.member_id)
+
+    return {r.member_id: (r.games_played, int(r.wins or 0), int(r.draws or 0)) for r in rows}
+
+
+def _games_required_by_member(event_id=None):
+    as_white = select([Fixture.white.label('member_id')])
+    as_black = select([Fixture.black.label('member_id')])
+
+    if event_id is not None:
+        as_white = as_white.where(Fixture.event_id == event_id)
+        as_black = as_black.where(Fixture.event_id == event_id)
+
+    sides = union_all(as_white, as_black).alias('fixture_sides')
+
+    rows = db.session.query(sides.c.member_id, func.count()).group_by(sides.c.member_id)
+
+    return {member_id: count for member_id, count in rows}
+
+
+def rebuild_standings(event_id=None):
+    # Full recompute of the materialized standings from games and fixtures. Meant for repairs and seeding.
+    # Closed events keep their frozen snapshot and are skipped
+    events = [Event.query.get(event_id)] if event_id is not None else Event.query.all()
+
+    for event in events:
+        if event.closed_at is not None:
+            logger.info(f'Event {event.id} is closed. Keeping its frozen standings')
+            continue
+        _rebuild_event_standings(event)
+
+    db.session.commit()
+
+
+def close_event(event_id):
+    # Rebuilds the standings one last time and freezes them into the event. From then on the event is served from
+    # the snapshot, never recomputed, and its fixtures no longer accept games
+    event = Event.query.get(event_id)
+    if event.closed_at is not None:
+        raise ValueError(f'Event {event_id} is already closed')
+
+    _rebuild_event_standings(event)
+    db.session.flush()
+
+    event.standings_snapshot = get_ranking_data(event_id)
+    event.closed_at = datetime.now()
+    event.active = False
     db.session.commit()
+    logger.info(f'Event {event_id} closed with {len(event.standings_snapshot)} frozen standings')
+
+
+def set_tiebreak_order(event_id, tiebreak_order):
+    event = Event.query.get(event_id)
+    if event.closed_at is not None:
+        raise ValueError(f'Event {event_id} is closed, its standings are frozen')
+
+    unknown = [name for name in tiebreak_order if name not in crosstable.TIEBREAKS]
+    if unknown or len(set(tiebreak_order)) != len(tiebreak_order):
+        raise ValueError(f'Invalid tiebreak order {tiebreak_order}. Use each of {", ".join(crosstable.TIEBREAKS)} at most once')
+
+    event.tiebreak_order = list(tiebreak_order)
+    _bump_data_version(event_id)  # Cached rankings and crosstables were ordered with the old tiebreaks
+    db.session.commit()
+    logger.info(f'Event {event_id} tiebreak order set to {tiebreak_order}')
+
 
-def get_ranking_data():
+def _rebuild_event_standings(event):
+    logger.info(f'Rebuilding standings for event {event.id}...')
+    results = _game_results_by_member(event.id)
+    games_required = _games_required_by_member(event.id)
+    rating_column = Member.glicko_rating if event.rating_system == 'glicko2' else Member.acl_elo
+    ratings = dict(db.session.query(Member.lichess_id, rating_column)
+                             .filter(Member.lichess_id.in_(list(games_required))))
+
+    Standing.query.filter_by(event_id=event.id).delete(synchronize_session=False)
+
+    for member_id, required in games_required.items():
+        games_played, wins, draws = results.get(member_id, (0, 0, 0))
+        db.session.add(Standing(member_id=member_id, event_id=event.id,
+                                wins=wins, draws=draws, losses=games_played - wins - draws,
+                                games_played=games_played, games_required=required,
+                                rating=ratings.get(member_id)))
+
+    _bump_data_version(event.id)
+
+
+def get_active_event_id():
+    event = Event.query.filter_by(active=True).order_by(Event.id.desc()).first()
+    return event.id if event else None
+
+
+def get_ranking_data(event_id=None):
+    # Standings in ranking order: points, then the event's tiebreaks (crosstable.tiebreak_keys). Tiebreaks need
+    # every opponent's final score, so they come from one pass over all the event's games
     logger.debug('Gathering ranking data...')
     ranking_data = []
 
-    for member in Member.query.all():
-        games_required = len(list(Fixture.query.filter_by(white=member.lichess_id)) + 
-                             list(Fixture.query.filter_by(black=member.lichess_id)))
+    if event_id is None:
+        event_id = get_active_event_id()
 
-        games_as_white = list(Game.query.filter_by(white=member.lichess_id))
-        games_as_black = list(Game.query.filter_by(black=member.lichess_id))
-        games_played = games_as_white + games_as_black
+    snapshot, tiebreak_order = db.session.query(Event.standings_snapshot, Event.tiebreak_order) \
+                                         .filter(Event.id == event_id).first() or (None, None)
+    if snapshot is not None:
+        return snapshot
 
-        wins = len([g for g in games_as_white if g.outcome == 'white'] + 
-                   [g for g in games_as_black if g.outcome == 'black'])
-        
-        draws = len([g for g in games_played if g.outcome == 'draw'])
+    if tiebreak_order is None:
+        tiebreak_order = crosstable.DEFAULT_TIEBREAK_ORDER
+    rows = db.session.query(Standing, Member.acl_username) \
+                     .join(Member, Member.lichess_id == Standing.member_id) \
+                     .filter(Standing.event_id == event_id).all()
 
-        losses = len(games_played) - wins - draws
+    member_ids, matrices = _event_matrices(event_id, [standing.member_id for standing, _ in rows])
+    index = {member_id: i for i, member_id in enumerate(member_ids)}
+    keys = crosstable.tiebreak_keys(matrices, tiebreak_order)
 
-        logger.debug(f'{member.lichess_id} - {member.acl_elo} - {wins}W-{draws}D-{losses}L')
+    for standing, username in rows:
+        logger.debug(f'{standing.member_id} - {standing.rating} - {standing.wins}W-{standing.draws}D-{standing.losses}L')
+        i = index[standing.member_id]
         player_data = {}
-        player_data['id'] = member.lichess_id
-        player_data['username'] = member.acl_username
-        player_data['wins'] = wins
-        player_data['losses'] = losses
-        player_data['draws'] = draws
-        player_data['aelo'] = member.acl_elo
-        player_data['games_played'] = len(games_as_black + games_as_white)
-        player_data['games_required'] = games_required
+        player_data['id'] = standing.member_id
+        player_data['username'] = username
+        player_data['wins'] = standing.wins
+        player_data['losses'] = standing.losses
+        player_data['draws'] = standing.draws
+        player_data['points'] = float(keys['points'][i])
+        player_data['tiebreaks'] = {name: float(keys[name][i]) for name in tiebreak_order}
+        player_data['aelo'] = standing.rating
+        player_data['games_played'] = standing.games_played
+        player_data['games_required'] = standing.games_required
         ranking_data.append(player_data)
-    
+
+    # Rows are ranked among themselves, members of the games with no standing only count as opponents
+    rows_idx = np.array([index[player_data['id']] for player_data in ranking_data], dtype=np.int64)
+    order = crosstable.rank({name: values[rows_idx] for name, values in keys.items()})
+    ranking_data = [ranking_data[i] for i in order.tolist()]
+    for position, player_data in enumerate(ranking_data, 1):
+        player_data['rank'] = position
+
     return ranking_data
 
-def get_fixtures():
+
+def get_event_standings(event_id):
+    event = Event.query.get(event_id)
+    return {'event_id': event.id, 'active': event.active, 'closed_at': event.closed_at,
+            'frozen': event.closed_at is not None, 'standings': get_ranking_data(event.id)}
+
+
+def _event_matrices(event_id, member_ids=()):
+    # Every game of the event in one query on the slim games columns, folded into members x members matrices.
+    # Members are member_ids plus everyone who played, sorted by id
+    # A core select skips the ORM's per-row tuple construction, which dominates at tens of thousands of games
+    games = db.session.execute(select([Game.white, Game.black, Game.outcome]).where(Game.event_id == event_id)).fetchall()
+    member_ids = sorted(set(member_ids) | {white for white, _, _ in games} | {black for _, black, _ in games})
+
+    white_idx, black_idx, white_score = encode_games(member_ids, games)
+    return member_ids, crosstable.score_matrices(white_idx, black_idx, white_score, len(member_ids))
+
+
+def get_crosstable(event_id):
+    # Members are listed in the same order as the event's standings (points, then tiebreaks)
+    tiebreak_order = db.session.query(Event.tiebreak_order).filter(Event.id == event_id).scalar()
+    if tiebreak_order is None:
+        tiebreak_order = crosstable.DEFAULT_TIEBREAK_ORDER
+    standings = [member_id for member_id, in db.session.query(Standing.member_id).filter(Standing.event_id == event_id)]
+    member_ids, matrices = _event_matrices(event_id, standings)
+    order = crosstable.standings_order(matrices, tiebreak_order)
+    matrices = crosstable.reorder(matrices, order)
+
+    usernames = dict(db.session.query(Member.lichess_id, Member.acl_username).filter(Member.lichess_id.in_(member_ids)))
+    members = [{'id': member_ids[i], 'username': usernames.get(member_ids[i]),
+                'points': float(points), 'games': int(n_games)}
+               for i, points, n_games in zip(order.tolist(), matrices['points'].sum(axis=1), matrices['games'].sum(axis=1))]
+
+    return {'event_id': event_id, 'tiebreak_order': tiebreak_order, 'members': members,
+            'points': matrices['points'].tolist(), 'games': matrices['games'].tolist(),
+            'white_games': matrices['white_games'].tolist(), 'white_points': matrices['white_points'].tolist()}
+
+
+def get_projections(event_id, n_simulations, workers=0, seed=None, draw_rate=projections.DRAW_RATE):
+    # Monte Carlo completion of the event's open fixtures from the current standings and ratings.
+    # Qualification is finishing in the top N of Event.playoffs_method ({'top': N}, default 2)
+    event = Event.query.get(event_id)
+    standings = db.session.query(Standing.member_id, Standing.wins, Standing.draws, Standing.rating) \
+                          .filter(Standing.event_id == event_id).all()
+    fixtures = db.session.execute(select([Fixture.white, Fixture.black])
+                                  .where(and_(Fixture.event_id == event_id, Fixture.game_id.is_(None)))).fetchall()
+
+    member_ids = sorted({member_id for member_id, _, _, _ in standings} | {w for w, _ in fixtures} | {b for _, b in fixtures})
+    members = {member_id: (username, elo) for member_id, username, elo
+               in db.session.query(Member.lichess_id, Member.acl_username, Member.acl_elo)
+                            .filter(Member.lichess_id.in_(member_ids))}
+    points = {member_id: wins + draws / 2 for member_id, wins, draws, _ in standings}
+    ratings = {member_id: rating for member_id, _, _, rating in standings if rating is not None}
+
+    points = np.array([points.get(m, 0) for m in member_ids], dtype=np.float64)
+    ratings = np.array([ratings.get(m) or members.get(m, (None, None))[1] or INITIAL_RATING for m in member_ids],
+                       dtype=np.float64)
+    white_idx, black_idx, _ = encode_games(member_ids, [(w, b, None) for w, b in fixtures])
+    p_white, p_draw = projections.outcome_probabilities(ratings[white_idx], ratings[black_idx], draw_rate)
+
+    top = min((event.playoffs_method or {}).get('top', 2), len(member_ids))
+    if member_ids:
+        positions, expected_points = projections.simulate(points, white_idx, black_idx, p_white, p_draw,
+                                                          n_simulations, seed=seed, workers=workers)
+    else:
+        positions, expected_points = np.zeros((0, 0)), np.zeros(0)
+
+    # Positions are 1-based. Each member lists the probabilities of positions best_position to worst_position
+    result = []
+    for i, member_id in enumerate(member_ids):
+        reached = np.flatnonzero(positions[i])
+        best, worst = int(reached[0]), int(reached[-1])
+        result.append({'id': member_id, 'username': members.get(member_id, (None, None))[0],
+                       'rating': float(ratings[i]), 'points': float(points[i]),
+                       'expected_points': round(float(expected_points[i]), 3),
+                       'qualification_probability': round(float(positions[i, :top].sum()), 5),
+                       'expected_position': round(float(positions[i] @ np.arange(1, len(member_ids) + 1)), 3),
+                       'best_position': best + 1, 'worst_position': worst + 1,
+                       'position_probabilities': np.round(positions[i, best:worst + 1], 5).tolist()})
+
+    result.sort(key=lambda member: (member['expected_position'], member['id']))
+    return {'event_id': event_id, 'qualifying_positions': top, 'simulations': n_simulations,
+            'remaining_fixtures': len(fixtures), 'members': result}
+
+
+def _fixtures_query(event_id=None, round_number=None, player=None, status=None, deadline_from=None, deadline_to=None):
+    query = Fixture.query
+
+    if event_id is not None:
+        query = query.filter(Fixture.event_id == event_id)
+    if round_number is not None:
+        query = query.filter(Fixture.round_number == round_number)
+    if player is not None:
+        query = query.filter(or_(Fixture.white == player, Fixture.black == player))
+    if status == 'open':
+        query = query.filter(Fixture.game_id.is_(None))
+    elif status == 'fulfilled':
+        query = query.filter(Fixture.game_id.isnot(None))
+    if deadline_from is not None:
+        query = query.filter(Fixture.deadline >= deadline_from)
+    if deadline_to is not None:
+        query = query.filter(Fixture.deadline <= deadline_to)
+
+    return query
+
+
+def count_fixtures(**filters):
+    return _fixtures_query(**filters).count()
+
+
+def get_fixtures(after=None, limit=None, **filters):
+    # Without arguments this is every fixture. With limit, pages are read by id: pass the last id seen as after
+    query = _fixtures_query(**filters).order_by(Fixture.id)
+
+    if after is not None:
+        query = query.filter(Fixture.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+
     fixtures = []
     
-    for f in Fixture.query.all():
+    for f in query:
 
         fixture = {'id': f.id, 'white': f.white, 'black': f.black, 
                    'game_id': f.game_id, 'outcome': f.outcome, 
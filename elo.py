@@ -1,16 +1,81 @@
+import numpy as np
+
+K_FACTOR = 32
+INITIAL_RATING = 1000
+
+RESULT_MAPPING = {'white': (1, 0), 'black': (0, 1), 'draw': (0.5, 0.5)}
+
+
 def get_expected_result(white_elo, black_elo):
     return 1 / (1 + 10 ** ((black_elo - white_elo) / 400))
 
-def get_rating_deltas(white_elo, black_elo, outcome):
-    result_mapping = {'white': (1, 0), 'black': (0, 1), 'draw': (0.5, 0.5)}
-    white_score, black_score = result_mapping[outcome]
+def get_rating_deltas(white_elo, black_elo, outcome, k_factor=K_FACTOR):
+    white_score, black_score = RESULT_MAPPING[outcome]
 
     expected_white = get_expected_result(white_elo, black_elo)
 
-    white_delta = 32 * (white_score - expected_white)
-    black_delta = 32 * (black_score - (1 - expected_white))
+    white_delta = k_factor * (white_score - expected_white)
+    black_delta = k_factor * (black_score - (1 - expected_white))
     return white_delta, black_delta
 
+
+def encode_games(member_ids, games):
+    # (white, black, outcome) tuples as white index, black index (positions in member_ids) and white score arrays.
+    # Dict lookups into preallocated arrays are several times faster than sorting and searching string arrays
+    index = {member_id: i for i, member_id in enumerate(member_ids)}
+    scores = {outcome: white_score for outcome, (white_score, _) in RESULT_MAPPING.items()}
+
+    try:
+        white_idx = np.fromiter((index[g[0]] for g in games), dtype=np.int64, count=len(games))
+        black_idx = np.fromiter((index[g[1]] for g in games), dtype=np.int64, count=len(games))
+    except KeyError as e:
+        raise KeyError(f'Game history contains players that are not in member_ids: {e}')
+
+    white_score = np.fromiter((scores.get(g[2], 0.0) for g in games), dtype=np.float64, count=len(games))
+    return white_idx, black_idx, white_score
+
+
+class EloReplay:
+    # Replays an ordered game history from the initial rating, with ratings held in an array indexed by member.
+    # Every game depends on the ratings its players got from their previous games, so this is a plain loop
+
+    def __init__(self, member_ids, k_factor=K_FACTOR, initial_rating=INITIAL_RATING):
+        self.member_ids = list(member_ids)
+        self.member_index = {m: i for i, m in enumerate(self.member_ids)}
+        self.k_factor = k_factor
+        self.initial_rating = initial_rating
+
+        self.ratings = np.full(len(self.member_ids), initial_rating, dtype=np.float64)
+        self.history = None
+
+    def encode(self, games):
+        return encode_games(self.member_ids, games)
+
+    def replay(self, games, record_history=False):
+        # Replay the full ordered history `games`. With record_history, self.history holds the ratings before and
+        # the white delta of every game, as (white_before, black_before, white_delta) arrays
+        white_idx, black_idx, white_score = self.encode(games)
+        ratings = [float(self.initial_rating)] * len(self.member_ids)
+        white_before, black_before, white_delta = [], [], []
+
+        for w, b, score in zip(white_idx.tolist(), black_idx.tolist(), white_score.tolist()):
+            delta = self.k_factor * (score - get_expected_result(ratings[w], ratings[b]))
+            if record_history:
+                white_before.append(ratings[w])
+                black_before.append(ratings[b])
+                white_delta.append(delta)
+            ratings[w] += delta
+            ratings[b] -= delta
+
+        self.ratings = np.array(ratings, dtype=np.float64)
+        self.history = tuple(np.array(values, dtype=np.float64) for values in [white_before, black_before, white_delta]) \
+                       if record_history else None
+        return self.get_ratings()
+
+    def get_ratings(self):
+        return dict(zip(self.member_ids, self.ratings.tolist()))
+
+
 if __name__ == "__main__":
     from itertools import product
     w = [400, 600, 800, 1000, 1200, 1400]
@@ -18,4 +83,4 @@ if __name__ == "__main__":
         print(w, b)
         Ew, Eb = get_expected_result(w, b), get_expected_result(b, w)
 
-        print(get_rating_deltas(w, b, 'draw'))
\ No newline at end of file
+        print(get_rating_deltas(w, b, 'draw'))
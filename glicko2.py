@@ -0,0 +1,140 @@
+import numpy as np
+
+# Glicko-2 as described in http://www.glicko.net/glicko/glicko2.pdf
+# A whole rating period is processed at once, with every member's state held in arrays.
+
+INITIAL_RATING = 1500
+INITIAL_RD = 350
+INITIAL_VOLATILITY = 0.06
+TAU = 0.5  # System constant. Constrains volatility changes over time
+SCALE = 173.7178
+EPSILON = 1e-6
+
+
+def g(phi):
+    return 1 / np.sqrt(1 + 3 * phi ** 2 / np.pi ** 2)
+
+
+def E(mu, mu_j, phi_j):
+    return 1 / (1 + np.exp(-g(phi_j) * (mu - mu_j)))
+
+
+def _volatility(phi, sigma, delta, v, tau):
+    # Illinois method for every player at once. Players whose bracket has converged are left untouched
+    a = np.log(sigma ** 2)
+
+    def f(x):
+        ex = np.exp(x)
+        return ex * (delta ** 2 - phi ** 2 - v - ex) / (2 * (phi ** 2 + v + ex) ** 2) - (x - a) / tau ** 2
+
+    A = a.copy()
+    B = np.where(delta ** 2 > phi ** 2 + v, np.log(np.maximum(delta ** 2 - phi ** 2 - v, 1e-300)), a - tau)
+
+    # Where no upper bracket exists, step down until f changes sign
+    needs_bracket = delta ** 2 <= phi ** 2 + v
+    k = np.ones_like(a)
+    while True:
+        stepping = needs_bracket & (f(a - k * tau) < 0)
+        if not stepping.any():
+            break
+        k = np.where(stepping, k + 1, k)
+    B = np.where(needs_bracket, a - k * tau, B)
+
+    fA, fB = f(A), f(B)
+    active = np.abs(B - A) > EPSILON
+    while active.any():
+        C = A + (A - B) * fA / (fB - fA)
+        fC = f(C)
+
+        swap = fC * fB <= 0
+        A = np.where(active & swap, B, A)
+        fA = np.where(active & swap, fB, np.where(active, fA / 2, fA))
+        B = np.where(active, C, B)
+        fB = np.where(active, fC, fB)
+
+        active = np.abs(B - A) > EPSILON
+
+    return np.exp(A / 2)
+
+
+def rate_period(ratings, rds, volatilities, white_idx, black_idx, white_score, tau=TAU):
+    # Returns new (ratings, rds, volatilities) arrays after a rating period made of the given games.
+    # Members are array positions; white_idx/black_idx/white_score describe one game per position.
+    mu = (np.asarray(ratings, dtype=np.float64) - INITIAL_RATING) / SCALE
+    phi = np.asarray(rds, dtype=np.float64) / SCALE
+    sigma = np.asarray(volatilities, dtype=np.float64)
+    n = len(mu)
+
+    # Every game seen from both sides: (player, opponent, score)
+    player = np.concatenate([white_idx, black_idx])
+    opponent = np.concatenate([black_idx, white_idx])
+    score = np.concatenate([white_score, 1 - np.asarray(white_score, dtype=np.float64)])
+
+    g_j = g(phi[opponent])
+    e_j = E(mu[player], mu[opponent], phi[opponent])
+
+    v_inv = np.bincount(player, weights=g_j ** 2 * e_j * (1 - e_j), minlength=n)
+    improvement = np.bincount(player, weights=g_j * (score - e_j), minlength=n)
+    played = v_inv > 0
+
+    # Members who did not play only see their RD grow
+    new_mu, new_phi, new_sigma = mu.copy(), np.sqrt(phi ** 2 + sigma ** 2), sigma.copy()
+
+    if played.any():
+        v = 1 / v_inv[played]
+        delta = v * improvement[played]
+
+        new_sigma[played] = _volatility(phi[played], sigma[played], delta, v, tau)
+        phi_star = np.sqrt(phi[played] ** 2 + new_sigma[played] ** 2)
+        new_phi[played] = 1 / np.sqrt(1 / phi_star ** 2 + 1 / v)
+        new_mu[played] = mu[played] + new_phi[played] ** 2 * improvement[played]
+
+    return new_mu * SCALE + INITIAL_RATING, new_phi * SCALE, new_sigma
+
+
+def rate_player(rating, rd, volatility, results, tau=TAU):
+    # Scalar version for a single player. results is a list of (opponent_rating, opponent_rd, score)
+    ratings = np.array([rating] + [r for r, _, _ in results], dtype=np.float64)
+    rds = np.array([rd] + [d for _, d, _ in results], dtype=np.float64)
+    volatilities = np.full(len(ratings), volatility, dtype=np.float64)
+
+    opponents = np.arange(1, len(ratings))
+    new_ratings, new_rds, new_volatilities = rate_period(ratings, rds, volatilities,
+                                                         np.zeros(len(results), dtype=np.int64), opponents,
+                                                         np.array([s for _, _, s in results], dtype=np.float64),
+                                                         tau=tau)
+    return float(new_ratings[0]), float(new_rds[0]), float(new_volatilities[0])
+
+
+if __name__ == "__main__":
+    # Example from Glickman's paper: expect 1464.06 / 151.52 / 0.05999
+    print(rate_player(1500, 200, 0.06, [(1400, 30, 1), (1550, 100, 0), (1700, 300, 0)]))
+
+    # Throughput: the same synthetic history rated game by game vs. as a single rating period
+    import time
+
+    rng = np.random.default_rng(0)
+    for n_members, n_games in [(100, 10_000), (1000, 100_000)]:
+        white_idx = rng.integers(0, n_members, n_games)
+        black_idx = (white_idx + rng.integers(1, n_members, n_games)) % n_members
+        white_score = rng.choice([0, 0.5, 1], n_games)
+
+        ratings = np.full(n_members, INITIAL_RATING, dtype=np.float64)
+        rds = np.full(n_members, INITIAL_RD, dtype=np.float64)
+        volatilities = np.full(n_members, INITIAL_VOLATILITY)
+
+        n_per_game = min(n_games, 2000)
+        start = time.perf_counter()
+        for i in range(n_per_game):
+            w, b = white_idx[i], black_idx[i]
+            new_w = rate_player(ratings[w], rds[w], volatilities[w], [(ratings[b], rds[b], white_score[i])])
+            new_b = rate_player(ratings[b], rds[b], volatilities[b], [(ratings[w], rds[w], 1 - white_score[i])])
+            (ratings[w], rds[w], volatilities[w]), (ratings[b], rds[b], volatilities[b]) = new_w, new_b
+        per_game = n_per_game / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rate_period(ratings, rds, volatilities, white_idx, black_idx, white_score)
+        per_period = n_games / (time.perf_counter() - start)
+
+        print(f'{n_members} members / {n_games} games: '
+              f'per-game {per_game:,.0f} games/s - per-period {per_period:,.0f} games/s')
@@ -0,0 +1,99 @@
+import logging
+import re
+import threading
+import time
+
+import requests
+from google.auth import jwt
+
+import metrics
+
+logger = logging.getLogger('app')
+
+GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
+DEFAULT_MAX_AGE = 3600  # Used when a response has no Cache-Control max-age
+REFRESH_MARGIN = 0.1  # Refresh in the background once this fraction of max-age is left
+
+
+class CachedResource:
+    # A JSON document cached for as long as its Cache-Control max-age allows. Close to expiry it is refreshed
+    # in the background; once expired, concurrent callers wait on a single fetch instead of each making one.
+
+    def __init__(self, url, session=None, timeout=10):
+        self.url = url
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+        self._value = None
+        self._fetched_at = 0
+        self._max_age = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()  # Held by the one background refresh in flight
+
+    def _fresh(self, margin=0):
+        return self._value is not None and time.monotonic() < self._fetched_at + self._max_age * (1 - margin)
+
+    def _fetch(self):
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException:
+            metrics.observe_outbound('google', self.url, time.perf_counter() - start, error=True)
+            raise
+        metrics.observe_outbound('google', self.url, time.perf_counter() - start)
+
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        self._max_age = int(match.group(1)) if match else DEFAULT_MAX_AGE
+        self._value = response.json()
+        self._fetched_at = time.monotonic()
+        logger.debug(f'Fetched {self.url} (max-age {self._max_age}s)')
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                # A caller that found it expired may have fetched it already
+                if not self._fresh(margin=REFRESH_MARGIN):
+                    self._fetch()
+        except Exception as e:
+            # Keep serving the cached value until it actually expires
+            logger.warning(f'Background refresh of {self.url} failed: {e}')
+        finally:
+            self._refresh_lock.release()
+
+    def get(self):
+        if self._fresh(margin=REFRESH_MARGIN):
+            return self._value
+
+        if self._fresh():
+            # Non-blocking acquire, so only one caller starts a refresh and the others return right away
+            if self._refresh_lock.acquire(blocking=False):
+                threading.Thread(target=self._background_refresh, daemon=True).start()
+            return self._value
+
+        with self._lock:
+            # Whoever held the lock before us may have fetched it already
+            if not self._fresh():
+                self._fetch()
+            return self._value
+
+
+discovery_document = CachedResource(GOOGLE_DISCOVERY_URL)
+signing_certs = CachedResource(GOOGLE_CERTS_URL)
+
+
+def verify_id_token(token, audience):
+    # Same checks as google.oauth2.id_token.verify_oauth2_token, but against the cached certificates.
+    # Raises ValueError for invalid tokens.
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+
+    idinfo = jwt.decode(token, certs=signing_certs.get(), audience=audience)
+
+    if idinfo['iss'] not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer. 'iss' should be one of the following: {GOOGLE_ISSUERS}")
+
+    return idinfo
@@ -0,0 +1,99 @@
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import db_ops
+import lichess
+from models import db, Event, Fixture, Game
+
+logger = logging.getLogger('app')
+
+
+def read_gamelist(path):
+    # Gamelist files hold lichess game links. The game id is the first 8 characters of the last path part
+    with open(path, 'r') as f:
+        game_links = json.load(f)
+
+    return [link.split('/')[-1][:8] for link in game_links]
+
+
+def fetch_game_exports(game_ids, client=None, max_workers=8):
+    # Fetch game exports concurrently over the pooled lichess client. Failed fetches are logged and skipped
+    client = client or lichess.get_client()
+
+    def fetch(game_id):
+        try:
+            return client.export_game(game_id)
+        except Exception as e:
+            logger.error(f'Error fetching game {game_id}: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return [gamedata for gamedata in pool.map(fetch, game_ids) if gamedata is not None]
+
+
+class FixtureMatcher:
+    # Open fixtures keyed by (white, black, time_base, time_increment). Rounds are tried in order
+
+    def __init__(self, fixtures):
+        self.open_fixtures = defaultdict(list)
+        for f in sorted(fixtures, key=lambda f: (f.round_number, f.id)):
+            if not f.game_id:
+                self.open_fixtures[(f.white, f.black, f.time_base, f.time_increment)].append(f)
+
+    @staticmethod
+    def key(lichess_gamedata):
+        try:
+            return (lichess_gamedata['players']['white']['user']['id'],
+                    lichess_gamedata['players']['black']['user']['id'],
+                    lichess_gamedata['clock']['initial'],
+                    lichess_gamedata['clock']['increment'])
+        except KeyError:
+            # Anonymous players or games without a clock can't belong to any fixture
+            return None
+
+    def candidates(self, lichess_gamedata):
+        # Every open fixture the game could fulfill, earliest round first
+        return list(self.open_fixtures.get(self.key(lichess_gamedata), []))
+
+    def fulfill(self, fixture):
+        self.open_fixtures[(fixture.white, fixture.black, fixture.time_base, fixture.time_increment)].remove(fixture)
+
+
+def import_games(games):
+    # Match, validate, insert and rate a list of lichess game exports in one transaction. Returns the accepted game ids
+    # Fixtures of closed events can never accept a game, so they are not candidates
+    open_fixtures = Fixture.query.join(Event, Event.id == Fixture.event_id) \
+                                 .filter(Fixture.game_id.is_(None), Event.closed_at.is_(None)).all()
+    matcher = FixtureMatcher(open_fixtures)
+    existing_ids = {game_id for game_id, in db.session.query(Game.id).filter(Game.id.in_([g['id'] for g in games]))}
+
+    accepted = []
+    for gamedata in sorted(games, key=lambda g: g['createdAt']):
+        candidates = matcher.candidates(gamedata)
+        if not candidates:
+            logger.warning(f'No open fixture for game {gamedata["id"]}')
+            continue
+
+        # A round whose deadline has passed doesn't stop the game from fulfilling the same pairing in a later round
+        for fixture in candidates:
+            validation = db_ops.check_game(fixture, gamedata, new_game=gamedata['id'] not in existing_ids)
+            if all(validation.values()):
+                matcher.fulfill(fixture)
+                existing_ids.add(gamedata['id'])
+                accepted.append((fixture, gamedata))
+                break
+        else:
+            logger.warning(f'Invalid game {gamedata["id"]}: {validation}')
+
+    logger.info(f'Importing {len(accepted)} of {len(games)} games')
+    imported, _ = db_ops.add_games_to_db(accepted)
+    return imported
+
+
+def import_gamelist(path, client=None, max_workers=8):
+    game_ids = read_gamelist(path)
+    logger.debug(f'Loading {len(game_ids)} games from {path}')
+
+    return import_games(fetch_game_exports(game_ids, client=client, max_workers=max_workers))
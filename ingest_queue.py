@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, exists, or_
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import aliased
+
+import db_ops
+from models import db, Fixture, IngestJob
+
+logger = logging.getLogger('app')
+
+# Queued /game submissions (INGEST_MODE = 'queue'), processed by a pool of background threads through
+# db_ops.accept_game. Jobs live in the app database, so there is no broker, any worker process can report a
+# job's status, and jobs enqueued by one process can be picked up by another. A job is only claimed once no
+# older queued or running job shares one of its players, so each member's games are rated in submission order.
+
+ACTIVE_STATUSES = ['queued', 'running']
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def enqueue(fixture_id, lichess_gamedata):
+    players = db.session.query(Fixture.white, Fixture.black).filter(Fixture.id == fixture_id).first()
+    white, black = players if players else (None, None)
+
+    job = IngestJob(fixture_id=fixture_id, game_id=lichess_gamedata.get('id'), white=white, black=black,
+                    lichess_gamedata=lichess_gamedata, submitted_at=datetime.utcnow())
+    db.session.add(job)
+    db.session.commit()
+
+    if _pool is not None:
+        _pool.wake()
+
+    return job
+
+
+def get_job(job_id):
+    return IngestJob.query.get(job_id)
+
+
+def claim_next_job():
+    # Oldest queued job without an older unfinished job for the same players. The conditional update makes sure
+    # only one worker (in any process) gets it
+    while True:
+        older = aliased(IngestJob)
+        players = [IngestJob.white, IngestJob.black]
+        blocked = exists().where(and_(older.id < IngestJob.id, older.status.in_(ACTIVE_STATUSES),
+                                      or_(older.white.in_(players), older.black.in_(players))))
+
+        job_id = db.session.query(IngestJob.id).filter(IngestJob.status == 'queued', ~blocked) \
+                                               .order_by(IngestJob.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        claimed = IngestJob.query.filter(IngestJob.id == job_id, IngestJob.status == 'queued') \
+                                 .update({IngestJob.status: 'running', IngestJob.started_at: datetime.utcnow()},
+                                         synchronize_session=False)
+        db.session.commit()
+
+        if claimed:
+            return IngestJob.query.get(job_id)
+
+
+def process_job(job, retries=3):
+    # The game and the job's result are committed together, so a job that was interrupted can simply be rerun
+    job_id, fixture_id, lichess_gamedata = job.id, job.fixture_id, job.lichess_gamedata
+
+    for attempt in range(retries + 1):
+        try:
+            validation_data = db_ops.accept_game(fixture_id, lichess_gamedata, commit=False)
+            job = IngestJob.query.get(job_id)
+            job.validation = validation_data
+            job.accepted = all(validation_data.values())
+            job.status = 'done'
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            return job
+
+        except OperationalError as e:
+            # Database locked by another writer (SQLite)
+            db.session.rollback()
+            if attempt < retries:
+                time.sleep(0.1 * 2 ** attempt)
+                continue
+            error = e
+
+        except Exception as e:
+            db.session.rollback()
+            error = e
+            break
+
+    logger.error(f'Ingest job {job_id} failed: {error}')
+    job = IngestJob.query.get(job_id)
+    job.status = 'failed'
+    job.error = f'{type(error).__name__}: {error}'
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+
+def requeue_stale_jobs(older_than):
+    # Jobs left running by a worker that died. Nothing of theirs was committed, so they can run again
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    requeued = IngestJob.query.filter(IngestJob.status == 'running', IngestJob.started_at < cutoff) \
+                              .update({IngestJob.status: 'queued', IngestJob.started_at: None},
+                                      synchronize_session=False)
+    db.session.commit()
+    if requeued:
+        logger.warning(f'Requeued {requeued} stale ingest jobs')
+    return requeued
+
+
+class WorkerPool:
+
+    def __init__(self, app, n_workers=4, poll_interval=0.5):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event()
+        self.threads = [threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True)
+                        for i in range(n_workers)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def wake(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _run(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    job = claim_next_job()
+                    if job is not None:
+                        process_job(job)
+                except Exception as e:
+                    logger.exception(f'Ingest worker error: {e}')
+                    db.session.rollback()
+                    job = None
+                finally:
+                    db.session.remove()
+
+                if job is None:
+                    # Also polls, for jobs enqueued by other processes
+                    with self._wakeup:
+                        self._wakeup.wait(self.poll_interval)
+
+
+def init_app(app):
+    app.config.setdefault('INGEST_MODE', 'sync')
+    app.config.setdefault('INGEST_WORKERS', 4)
+    app.config.setdefault('INGEST_POLL_INTERVAL', 0.5)
+    app.config.setdefault('INGEST_STALE_AFTER', 300)
+
+    if app.config['INGEST_MODE'] == 'queue':
+        # Threads are started per process on its first request, so they survive servers that fork workers
+        app.before_first_request(lambda: start_workers(app))
+
+
+def start_workers(app):
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            requeue_stale_jobs(app.config['INGEST_STALE_AFTER'])
+            _pool = WorkerPool(app, app.config['INGEST_WORKERS'], app.config['INGEST_POLL_INTERVAL']).start()
+            logger.info(f'Started {app.config["INGEST_WORKERS"]} ingest workers')
+
+    return _pool
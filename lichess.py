@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from cachetools import LRUCache, TTLCache
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger('app')
+
+LICHESS_URL = 'https://lichess.org'
+RATE_LIMIT_WAIT = 60  # Lichess asks clients to wait a full minute after a 429 without Retry-After
+
+# Games in these states can still change. Anything else is final and cached for good
+ONGOING_STATUSES = {'created', 'started'}
+
+
+def _retry_after(response):
+    # Seconds to wait after a 429. Retry-After may also be an HTTP date, which gets the default wait
+    try:
+        return float(response.headers.get('Retry-After', RATE_LIMIT_WAIT))
+    except ValueError:
+        return RATE_LIMIT_WAIT
+
+
+class LichessClient:
+    # Shared keep-alive session for every call to Lichess. Honors 429s across all threads using the client,
+    # caches finished game exports (LRU) and user profiles (TTL), and keeps latency counters per endpoint.
+
+    def __init__(self, base_url=LICHESS_URL, timeout=10, max_retries=3, pool_size=10,
+                 game_cache_size=10000, user_cache_size=1000, user_ttl=300):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self._blocked_until = 0
+        self._games = LRUCache(maxsize=game_cache_size)
+        self._users = TTLCache(maxsize=user_cache_size, ttl=user_ttl)
+        self._stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'cache_hits': 0,
+                                           'total_seconds': 0.0, 'max_seconds': 0.0})
+
+    def request(self, method, path, endpoint, **kwargs):
+        # endpoint is the label latency is recorded under (e.g. 'game_export' rather than the full path)
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, f'{self.base_url}{path}', **kwargs)
+            except requests.ConnectionError:
+                self._record(endpoint, time.perf_counter() - start, error=True)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+
+            self._record(endpoint, time.perf_counter() - start, error=not response.ok)
+
+            if response.status_code == 429 and attempt < self.max_retries:
+                retry_after = _retry_after(response)
+                logger.warning(f'Lichess rate limit hit on {endpoint}. Pausing requests for {retry_after}s')
+                with self._lock:
+                    self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+                continue
+
+            if response.status_code >= 500 and attempt < self.max_retries:
+                time.sleep(2 ** attempt)
+                continue
+
+            response.raise_for_status()
+            return response
+
+    def _record(self, endpoint, seconds, error=False, cache_hit=False):
+        with self._lock:
+            stats = self._stats[endpoint]
+            if cache_hit:
+                stats['cache_hits'] += 1
+                return
+
+            stats['requests'] += 1
+            stats['errors'] += int(error)
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+
+        metrics.observe_outbound('lichess', endpoint, seconds, error)
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._stats.items()}
+
+    def export_game(self, game_id):
+        with self._lock:
+            gamedata = self._games.get(game_id)
+
+        if gamedata is not None:
+            self._record('game_export', 0, cache_hit=True)
+            return gamedata
+
+        gamedata = self.request('GET', f'/game/export/{game_id}', 'game_export',
+                                headers={'Accept': 'application/json'}).json()
+
+        if gamedata.get('status') not in ONGOING_STATUSES:
+            with self._lock:
+                self._games[game_id] = gamedata
+
+        return gamedata
+
+    def get_users(self, user_ids):
+        # Bulk profile lookup. Only ids missing from the TTL cache are requested
+        user_ids = [user_id.lower() for user_id in user_ids]
+        with self._lock:
+            users = {user_id: self._users[user_id] for user_id in user_ids if user_id in self._users}
+
+        if users:
+            self._record('users', 0, cache_hit=True)
+
+        missing = [user_id for user_id in user_ids if user_id not in users]
+        if missing:
+            fetched = self.request('POST', '/api/users', 'users', data=','.join(missing)).json()
+            with self._lock:
+                for user in fetched:
+                    self._users[user['id']] = user
+                    users[user['id']] = user
+
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    def get_account(self, access_token):
+        # Per-token data, never cached
+        return self.request('GET', '/api/account', 'account',
+                            headers={'Authorization': f'Bearer {access_token}'}).json()
+
+    def user_games(self, username, **params):
+        # Generator over a user's games, decoded one NDJSON line at a time so memory stays flat
+        response = self.request('GET', f'/api/games/user/{username}', 'user_games', params=params, stream=True,
+                                headers={'Accept': 'application/x-ndjson'})
+        try:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            response.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # Process-wide client. LICHESS_URL points it at a local stand-in for tests
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = LichessClient(base_url=os.getenv('LICHESS_URL', LICHESS_URL))
+        return _client
@@ -0,0 +1,173 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+from flask import json
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Event
+
+logger = logging.getLogger('app')
+
+# In-process pub/sub behind GET /stream (Server-Sent Events). Accepted games are published once their transaction
+# commits. A publish serializes the message once and hands it to every subscriber's queue, so it costs no database
+# work per client, and an idle client is just a connection waiting on its queue. Under gevent workers that wait
+# is a greenlet, so a process can hold many idle streams.
+# Games committed by another process never reach this one's broker. One watcher thread per process polls the
+# event data versions while anyone is subscribed and publishes the versions that moved, so clients refetch.
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def format_message(message_id, name, data):
+    return f'id: {message_id}\nevent: {name}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+class Subscription:
+
+    def __init__(self, max_pending):
+        self.queue = queue.Queue(max_pending)
+        self.closed = False
+
+
+class Broker:
+
+    def __init__(self, backlog=100, max_pending=100):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._backlog = deque(maxlen=backlog)  # (id, message) of the latest messages, replayed on reconnect
+        self.last_id = 0
+        self.max_pending = max_pending
+        self.versions = {}  # Event id -> latest data version clients were told about
+
+    def publish(self, name, data):
+        with self._lock:
+            self.last_id += 1
+            message = format_message(self.last_id, name, data)
+            self._backlog.append((self.last_id, message))
+            if 'event_id' in data and data.get('version') is not None:
+                self.versions[data['event_id']] = max(data['version'], self.versions.get(data['event_id'], 0))
+            subscribers = list(self._subscribers)
+
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # Client stopped reading. It gets dropped and catches up from the backlog when it reconnects
+                logger.warning('Dropping a /stream subscriber that is not keeping up')
+                self.unsubscribe(subscription)
+
+        return self.last_id
+
+    def subscribe(self, last_event_id=None):
+        subscription = Subscription(self.max_pending + self._backlog.maxlen)  # Room for a full replay
+
+        with self._lock:
+            if last_event_id is not None and last_event_id != self.last_id:
+                oldest = self._backlog[0][0] if self._backlog else self.last_id + 1
+                if oldest <= last_event_id + 1 <= self.last_id:
+                    for message_id, message in self._backlog:
+                        if message_id > last_event_id:
+                            subscription.queue.put_nowait(message)
+                else:
+                    # Missed more than the backlog holds, or the id is from before a restart: start over
+                    subscription.queue.put_nowait(format_message(self.last_id, 'reset', {}))
+            self._subscribers.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.closed = True
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def newer_versions(self, versions):
+        # Records versions and returns those ahead of what was published, as {event_id: version}
+        with self._lock:
+            newer = {event_id: version for event_id, version in versions.items()
+                     if version is not None and version > self.versions.get(event_id, 0)}
+            self.versions.update(newer)
+        return newer
+
+
+broker = Broker()
+
+
+def stream(subscription, heartbeat):
+    # Response body of GET /stream. The comment line keeps proxies from closing idle connections and surfaces
+    # clients that went away (the write fails and the generator is closed)
+    try:
+        yield 'retry: 3000\n\n'
+        while not subscription.closed:
+            try:
+                yield subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def publish_after_commit(data):
+    # Queues a 'game' message on the current transaction. It is only published if the transaction commits
+    db.session.info.setdefault('live_updates', []).append(data)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_pending(session):
+    for data in session.info.pop('live_updates', []):
+        broker.publish('game', data)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('live_updates', None)
+
+
+class VersionWatcher:
+
+    def __init__(self, app, poll_interval):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='live-updates-watcher', daemon=True)
+
+    def _run(self):
+        with self.app.app_context():
+            first = True
+            while True:
+                if first or broker.subscriber_count():
+                    try:
+                        newer = broker.newer_versions(dict(db.session.query(Event.id, Event.data_version)))
+                        if newer and not first:
+                            broker.publish('versions', {'versions': newer})
+                        first = False
+                    except Exception as e:
+                        logger.exception(f'Live updates watcher error: {e}')
+                    finally:
+                        db.session.remove()
+
+                time.sleep(self.poll_interval)
+
+
+def init_app(app):
+    app.config.setdefault('STREAM_HEARTBEAT', 15)
+    app.config.setdefault('STREAM_POLL_INTERVAL', 5)
+
+
+def subscribe(app, last_event_id=None):
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None or _watcher.pid != os.getpid():
+            _watcher = VersionWatcher(app, app.config['STREAM_POLL_INTERVAL'])
+            _watcher.thread.start()
+
+    return broker.subscribe(last_event_id)
@@ -0,0 +1,193 @@
+import cProfile
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from datetime import datetime
+from pathlib import Path
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('app')
+
+# Process-wide request, SQL and outbound HTTP metrics, exposed in the Prometheus text format by /metrics.
+# Under a multi-process server each worker keeps (and reports) its own numbers.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_set(names, values):
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in values)
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+class Counter:
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{{{_label_set(self.labels, label_values)}}} {value}' for label_values, value in values]
+        return lines
+
+
+class Histogram:
+    # Fixed buckets per label set. observe is one bisect and two additions; buckets are only made cumulative
+    # when rendered
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        with self._lock:
+            series = sorted((label_values, list(counts), total) for label_values, (counts, total) in self._series.items())
+
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        for label_values, counts, total in series:
+            labels = _label_set(self.labels, label_values)
+            separator = ',' if labels else ''
+            cumulative = 0
+            for bound, count in zip([f'{b:g}' for b in self.buckets] + ['+Inf'], counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+
+        return lines
+
+
+request_duration = Histogram('http_request_duration_seconds', 'Request latency by route',
+                             ('method', 'route', 'status'))
+request_queries = Histogram('http_request_sql_queries', 'SQL queries per request', ('route',), QUERY_COUNT_BUCKETS)
+request_db_duration = Histogram('http_request_db_seconds', 'Time spent in SQL per request', ('route',))
+query_budget_exceeded = Counter('http_request_sql_budget_exceeded_total',
+                                'Requests that ran more SQL queries than SQL_QUERY_BUDGET', ('route',))
+query_duration = Histogram('sql_query_duration_seconds', 'Duration of every SQL statement, in or out of requests')
+outbound_duration = Histogram('outbound_request_duration_seconds', 'HTTP calls to external services',
+                              ('service', 'endpoint'))
+outbound_errors = Counter('outbound_request_errors_total', 'Failed HTTP calls to external services',
+                          ('service', 'endpoint'))
+user_loads = Counter('user_loads_total', 'Users loaded for authenticated requests, by source (session, cache, database)',
+                     ('source',))
+
+REGISTRY = [request_duration, request_queries, request_db_duration, query_budget_exceeded, query_duration,
+            outbound_duration, outbound_errors, user_loads]
+
+
+def render():
+    return '\n'.join(line for metric in REGISTRY for line in metric.render()) + '\n'
+
+
+def observe_outbound(service, endpoint, seconds, error=False):
+    # Called by the Lichess and Google clients around every HTTP call they make
+    outbound_duration.observe(seconds, service, endpoint)
+    if error:
+        outbound_errors.inc(service, endpoint)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_start'].pop()
+    query_duration.observe(seconds)
+
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_queries += 1
+        g.metrics_db_seconds += seconds
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+def init_app(app):
+    app.config.setdefault('SQL_QUERY_BUDGET', 30)
+    app.config.setdefault('PROFILER_SAMPLE_RATE', 0)
+    app.config.setdefault('PROFILER_DIR', '.profiles')
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+
+
+def _before_request():
+    g.metrics_queries = 0
+    g.metrics_db_seconds = 0
+    g.metrics_start = time.perf_counter()
+
+    # Profile a random sample of requests (e.g. PROFILER_SAMPLE_RATE = 0.01 for one in a hundred)
+    sample_rate = current_app.config['PROFILER_SAMPLE_RATE']
+    if sample_rate and random.random() < sample_rate:
+        g.metrics_profiler = cProfile.Profile()
+        g.metrics_profiler.enable()
+
+
+def _after_request(response):
+    if 'metrics_start' not in g:
+        return response
+
+    seconds = time.perf_counter() - g.metrics_start
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+    request_duration.observe(seconds, request.method, route, response.status_code)
+    request_queries.observe(g.metrics_queries, route)
+    request_db_duration.observe(g.metrics_db_seconds, route)
+    response.headers['Server-Timing'] = f'app;dur={seconds * 1000:.1f}, db;dur={g.metrics_db_seconds * 1000:.1f}'
+
+    budget = current_app.config['SQL_QUERY_BUDGET']
+    if budget and g.metrics_queries > budget:
+        query_budget_exceeded.inc(route)
+        current_app.logger.warning(f'{request.method} {route} ran {g.metrics_queries} SQL queries '
+                                   f'(budget {budget}, {g.metrics_db_seconds * 1000:.0f}ms in SQL)')
+
+    profiler = g.pop('metrics_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _dump_profile(profiler, route)
+
+    return response
+
+
+def _dump_profile(profiler, route):
+    profile_dir = Path(current_app.config['PROFILER_DIR'])
+    profile_dir.mkdir(exist_ok=True, parents=True)
+    name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '') or 'root'
+    path = profile_dir / f'{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}-{request.method}-{name}.prof'
+    profiler.dump_stats(path)
+    logger.debug(f'Profile of {request.method} {route} written to {path}')
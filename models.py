@@ -1,10 +1,23 @@
 from flask_login.mixins import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from flask import jsonify
+from flask import jsonify, json
 from sqlalchemy.dialects.postgresql import JSON, TIMESTAMP
+import zlib
 
 db = SQLAlchemy()
 
+
+class CompressedJSON(db.TypeDecorator):
+    # JSON stored as zlib-compressed bytes. Meant for large payloads that are rarely read
+    impl = db.LargeBinary
+
+    def process_bind_param(self, value, dialect):
+        return zlib.compress(json.dumps(value, separators=(',', ':')).encode()) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return json.loads(zlib.decompress(value)) if value is not None else None
+
+
 class User(db.Model, UserMixin):
     __tablename__='users'
     id = db.Column(db.String, primary_key=True)  # User Google ID
@@ -49,11 +62,19 @@ class Event(db.Model):
     rounds_duration = db.Column(JSON)  # List of length n_rounds. Number of days before round deadline
     rounds_time_format = db.Column(JSON)  # List of length n_rounds containing a dict with keys 'base' and 'increment' for each round
     
-    playoffs_method = db.Column(JSON)  # Unused for now
-    tiebreak_method = db.Column(JSON)  # Unused for now
+    playoffs_method = db.Column(JSON)  # {'top': N}: members qualifying for the playoffs. Used by projections
+    tiebreak_method = db.Column(JSON)  # Time format of playoff tiebreak games ({'base', 'increment'}). Unused for now
+    tiebreak_order = db.Column(JSON)  # Standings tiebreaks after points, e.g. ['direct_encounter', 'wins']. See crosstable
+    rating_system = db.Column(db.String, default='elo')  # 'elo' (updated every game) or 'glicko2' (updated per round)
+    last_rated_round = db.Column(db.Integer, default=0)  # Last round processed as a Glicko-2 rating period
 
     players = db.Column(JSON)
 
+    data_version = db.Column(db.Integer, default=0, nullable=False)  # Bumped whenever a game changes this event's results
+
+    closed_at = db.Column(TIMESTAMP)  # Set by close_event. Closed events are never recomputed
+    standings_snapshot = db.deferred(db.Column(JSON))  # Final standings, frozen when the event was closed
+
     def __repr__(self):
         return f'<Event {self.id}({self.n_rounds} rounds starting {self.start_date})>'
 
@@ -61,31 +82,45 @@ class Event(db.Model):
 class Game(db.Model):
     __tablename__='games'
     id = db.Column(db.String, primary_key=True)
-    date_played = db.Column(db.Date)
-    date_added = db.Column(db.Date)
+    date_played = db.Column(db.DateTime)  # Lichess createdAt (UTC). Ratings are replayed in this order
+    date_added = db.Column(db.DateTime)
     
-    white = db.Column(db.String)
-    black = db.Column(db.String)
+    white = db.Column(db.String, index=True)
+    black = db.Column(db.String, index=True)
     outcome = db.Column(db.String)
     winner = db.Column(db.String)
     
     time_base = db.Column(db.Integer)  # in seconds
     time_increment = db.Column(db.Integer)  # in seconds
 
-    lichess_gamedata = db.Column(JSON)
+    # The full lichess export lives in game_exports so queries on games stay on the slim columns
+    export = db.relationship('GameExport', uselist=False, lazy='select')
 
-    event_id = db.Column(db.Integer, db.ForeignKey('events.id'))
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), index=True)
 
     def __repr__(self):
         return f'<Game(Played on {self.date_played} - {self.white} (W) vs. {self.black} (B) - {self.time_base//60}+{self.time_increment}{" - Event " + str(self.event) if self.event else ""})>'
 
 
+class GameExport(db.Model):
+    __tablename__='game_exports'
+    game_id = db.Column(db.String, db.ForeignKey('games.id'), primary_key=True)
+    lichess_gamedata = db.Column(CompressedJSON)  # Moves, clocks and analysis as exported by lichess
+
+    def __repr__(self):
+        return f'<GameExport({self.game_id})>'
+
+
 class Member(db.Model):
     __tablename__='members'
     lichess_id = db.Column(db.String, primary_key=True)
     acl_username = db.Column(db.String)
     acl_elo = db.Column(db.Integer)
 
+    glicko_rating = db.Column(db.Float, default=1500)
+    glicko_rd = db.Column(db.Float, default=350)
+    glicko_volatility = db.Column(db.Float, default=0.06)
+
     lichess_username = db.Column(db.String)
     lichess_rapid_elo = db.Column(db.Integer)
     lichess_blitz_elo = db.Column(db.Integer)
@@ -93,17 +128,57 @@ class Member(db.Model):
     date_joined = db.Column(db.Date)
 
 
+class RatingChange(db.Model):
+    __tablename__='rating_history'
+    # One row per member per rated game, written when the game is accepted. ACL Elo only
+    # Serves a member's history in order: by date, then by the order games were rated within a day
+    __table_args__ = (db.Index('ix_rating_history_member_date', 'member_id', 'date_played', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    member_id = db.Column(db.String, db.ForeignKey('members.lichess_id'), nullable=False)
+    game_id = db.Column(db.String, db.ForeignKey('games.id'), nullable=False, index=True)
+    event_id = db.Column(db.Integer)
+    date_played = db.Column(db.Date)
+
+    rating_before = db.Column(db.Float)
+    rating_after = db.Column(db.Float)
+    delta = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<RatingChange({self.member_id} {self.rating_before:.0f} -> {self.rating_after:.0f} in game {self.game_id})>'
+
+
+class Standing(db.Model):
+    __tablename__='standings'
+    # Materialized per-event table, kept up to date on every accepted game (see db_ops)
+    member_id = db.Column(db.String, db.ForeignKey('members.lichess_id'), primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey('events.id'), primary_key=True, index=True)  # The key leads with member_id
+
+    wins = db.Column(db.Integer, default=0, nullable=False)
+    draws = db.Column(db.Integer, default=0, nullable=False)
+    losses = db.Column(db.Integer, default=0, nullable=False)
+    games_played = db.Column(db.Integer, default=0, nullable=False)
+    games_required = db.Column(db.Integer, default=0, nullable=False)
+    rating = db.Column(db.Integer)
+
+    def __repr__(self):
+        return f'<Standing({self.member_id} @ Event {self.event_id} - {self.wins}W-{self.draws}D-{self.losses}L)>'
+
+
 class Fixture(db.Model):
     __tablename__='fixtures'
+    # Serves the event/round filters of /fixtures, with id last so keyset pagination reads in index order
+    __table_args__ = (db.Index('ix_fixtures_event_round', 'event_id', 'round_number', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     deadline = db.Column(db.Date)
     round_number = db.Column(db.Integer)
     
     event_id = db.Column(db.Integer, db.ForeignKey('events.id'), nullable=False)
-    event = db.relationship('Event', backref=db.backref('fixtures', lazy=False))
+    event = db.relationship('Event', backref='fixtures')
 
-    white = db.Column(db.String)
-    black = db.Column(db.String)
+    white = db.Column(db.String, index=True)
+    black = db.Column(db.String, index=True)
     game_id = db.Column(db.String)
     outcome = db.Column(db.String)
 
@@ -113,6 +188,37 @@ class Fixture(db.Model):
     def __repr__(self):
         return f'<Fixture({self.white} (w) vs. {self.black} (b). {self.time_base//60}+{self.time_increment})>'
 
+
+class IngestJob(db.Model):
+    __tablename__='ingest_jobs'
+    # Queued /game submissions (see ingest_queue). Workers claim the oldest queued job by status, then id
+    __table_args__ = (db.Index('ix_ingest_jobs_status', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String, default='queued', nullable=False)  # queued, running, done or failed
+
+    fixture_id = db.Column(db.Integer)
+    game_id = db.Column(db.String)
+    white = db.Column(db.String)  # Fixture players, used to process one job per member at a time
+    black = db.Column(db.String)
+    lichess_gamedata = db.Column(CompressedJSON)
+
+    validation = db.Column(JSON)
+    accepted = db.Column(db.Boolean)
+    error = db.Column(db.String)
+
+    submitted_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<IngestJob {self.id}({self.status} - fixture {self.fixture_id}, game {self.game_id})>'
+
+    def json(self):
+        return {'id': self.id, 'status': self.status, 'fixture_id': self.fixture_id, 'game_id': self.game_id,
+                'validation': self.validation, 'accepted': self.accepted, 'error': self.error,
+                'submitted_at': self.submitted_at, 'started_at': self.started_at, 'finished_at': self.finished_at}
+
 # class User(db.Model):
 #     __tablename__ = 'users'
 #     google_id = db.Column(db.String, primary_key=True)
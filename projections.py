@@ -0,0 +1,122 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from elo import get_expected_result
+
+# Monte Carlo completion of an event's remaining fixtures. Every simulation plays all unplayed fixtures at once:
+# outcomes are drawn for a (simulations x fixtures) block, folded into final points with one matrix product (or
+# bincount) and ranked with one sort per block, so there is no Python loop per simulation or per game.
+# Ratings are held fixed at their current values for the rest of the event.
+
+DRAW_RATE = 0.15  # Draw probability between equally rated players
+CHUNK_ELEMENTS = 2_000_000  # Simulations x fixtures drawn at once. Bounds memory to a few tens of MB
+DENSE_MEMBERS = 128  # Up to this many members, totals come from a matrix product rather than bincount
+
+
+def outcome_probabilities(white_ratings, black_ratings, draw_rate=DRAW_RATE):
+    # (white win, draw) probabilities. Draws get rarer as the rating gap grows and are taken evenly from both
+    # sides, so white's expected score stays get_expected_result
+    expected = get_expected_result(np.asarray(white_ratings, dtype=np.float64), np.asarray(black_ratings, dtype=np.float64))
+    draw = draw_rate * (1 - np.abs(2 * expected - 1))
+    return expected - draw / 2, draw
+
+
+def _simulate(points, white_idx, black_idx, p_white, p_draw, n_simulations, seed):
+    # Returns (count of simulations finishing member i in position j as an n x n array, summed final points).
+    # Scores are counted in half points so they stay small integers, exact in float32
+    rng = np.random.default_rng(seed)
+    n_members, n_fixtures = len(points), len(white_idx)
+    position_counts = np.zeros(n_members * n_members, dtype=np.int64)
+    half_points_sum = np.zeros(n_members, dtype=np.float64)
+
+    p_white = np.asarray(p_white, dtype=np.float32)
+    p_white_or_draw = np.asarray(p_white + p_draw, dtype=np.float32)
+    # Black's half points add up to 2 per fixture played with black, minus white's
+    base = 2 * np.asarray(points, dtype=np.float64) + 2 * np.bincount(black_idx, minlength=n_members)
+
+    chunk = max(1, min(n_simulations, CHUNK_ELEMENTS // max(n_fixtures, n_members, 1)))
+    if n_members <= DENSE_MEMBERS:
+        # Fixture x member matrix, +1 for white and -1 for black: one matrix product per chunk folds scores into totals
+        fixture_members = np.zeros((n_fixtures, n_members), dtype=np.float32)
+        np.add.at(fixture_members, (np.arange(n_fixtures), white_idx), 1)
+        np.add.at(fixture_members, (np.arange(n_fixtures), black_idx), -1)
+    else:
+        # Index of (simulation, member) in the flattened totals, for a full chunk. Shorter chunks use a prefix
+        offsets = np.arange(chunk)[:, None] * n_members
+        white_flat = (offsets + white_idx).ravel()
+        black_flat = (offsets + black_idx).ravel()
+    member_flat = (np.arange(n_members) * n_members)[None, :]
+
+    for start in range(0, n_simulations, chunk):
+        k = min(chunk, n_simulations - start)
+        u = rng.random((k, n_fixtures), dtype=np.float32)
+        white_score = (u < p_white).astype(np.float32) + (u < p_white_or_draw)
+
+        if n_members <= DENSE_MEMBERS:
+            totals = white_score @ fixture_members + base
+        else:
+            size = k * n_members
+            white_score = white_score.ravel()
+            totals = np.bincount(white_flat[:k * n_fixtures], weights=white_score, minlength=size) \
+                   - np.bincount(black_flat[:k * n_fixtures], weights=white_score, minlength=size)
+            totals = totals.reshape(k, n_members) + base
+
+        # Highest points first. Totals are whole half points, so a random fraction only splits members level on points
+        order = np.argsort(rng.random((k, n_members)) - totals, axis=1)
+        positions = np.empty_like(order)
+        np.put_along_axis(positions, order, np.broadcast_to(np.arange(n_members), order.shape), axis=1)
+
+        position_counts += np.bincount((member_flat + positions).ravel(), minlength=n_members * n_members)
+        half_points_sum += totals.sum(axis=0)
+
+    return position_counts.reshape(n_members, n_members), half_points_sum / 2
+
+
+def simulate(points, white_idx, black_idx, p_white, p_draw, n_simulations, seed=None, workers=0):
+    # points: current points per member. white_idx/black_idx/p_white/p_draw: one entry per remaining fixture.
+    # Returns (position probabilities, members x positions with position 0 the winner, expected final points).
+    # With workers > 1 the simulations are split across a process pool, each part with its own seed
+    points = np.asarray(points, dtype=np.float64)
+    n_parts = max(workers, 1)
+    sizes = [n_simulations // n_parts + (i < n_simulations % n_parts) for i in range(n_parts)]
+    seeds = np.random.SeedSequence(seed).spawn(n_parts)
+    args = [(points, white_idx, black_idx, p_white, p_draw, size, s) for size, s in zip(sizes, seeds) if size]
+
+    if n_parts > 1:
+        # Spawned rather than forked: the app process runs other threads (ingest workers, the web server)
+        with ProcessPoolExecutor(n_parts, mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_simulate, *zip(*args)))
+    else:
+        results = [_simulate(*a) for a in args]
+
+    position_counts = sum(counts for counts, _ in results)
+    points_sum = sum(points_sum for _, points_sum in results)
+    return position_counts / n_simulations, points_sum / n_simulations
+
+
+if __name__ == '__main__':
+    import os
+    import time
+
+    # Halfway through a double round-robin of n members
+    for n, n_simulations in [(10, 100_000), (100, 100_000), (300, 20_000)]:
+        rng = np.random.default_rng(0)
+        white_idx, black_idx = (a.ravel() for a in np.meshgrid(np.arange(n), np.arange(n), indexing='ij'))
+        unplayed = white_idx < black_idx  # One of the two games between each pair is left
+        white_idx, black_idx = white_idx[unplayed], black_idx[unplayed]
+        ratings = rng.normal(1000, 150, n)
+        points = rng.uniform(0, n / 2, n).round() / 2
+        p_white, p_draw = outcome_probabilities(ratings[white_idx], ratings[black_idx])
+
+        for workers in sorted({0, os.cpu_count()} - {1}):
+            start = time.perf_counter()
+            positions, expected_points = simulate(points, white_idx, black_idx, p_white, p_draw, n_simulations,
+                                                  seed=0, workers=workers)
+            seconds = time.perf_counter() - start
+
+            assert np.allclose(positions.sum(axis=0), 1) and np.allclose(positions.sum(axis=1), 1)
+            assert np.isclose(expected_points.sum(), points.sum() + len(white_idx))
+            print(f'{n} members, {len(white_idx)} fixtures, {n_simulations:,} simulations, {workers} workers: '
+                  f'{seconds:.2f}s ({n_simulations * len(white_idx) / seconds / 1e6:.1f}M games/s)')
@@ -0,0 +1,68 @@
+import hashlib
+import logging
+import threading
+
+from cachetools import LRUCache
+from flask import current_app, json, request
+
+logger = logging.getLogger('app')
+
+# Serialized payloads keyed by (name, data version). Entries for old versions are never read again
+# and simply age out of the LRU, so no explicit invalidation is needed.
+_cache = LRUCache(maxsize=64)
+_lock = threading.Lock()
+_building = {}  # key -> lock held while its payload is built, so concurrent misses build it once
+
+
+def configure(maxsize):
+    global _cache
+    with _lock:
+        _cache = LRUCache(maxsize=maxsize)
+
+
+def clear():
+    with _lock:
+        _cache.clear()
+
+
+def get_payload(key, build):
+    # Returns (data, body, etag) for key, building and serializing it only on a cache miss
+    with _lock:
+        entry = _cache.get(key)
+        if entry is None:
+            building = _building.setdefault(key, threading.Lock())
+
+    if entry is None:
+        with building:
+            with _lock:
+                entry = _cache.get(key)
+
+            if entry is None:
+                logger.debug(f'Response cache miss for {key}')
+                try:
+                    data = build()
+                    body = json.dumps(data)
+                    etag = hashlib.sha1(body.encode()).hexdigest()
+                    entry = (data, body, etag)
+
+                    with _lock:
+                        _cache[key] = entry
+                finally:
+                    with _lock:
+                        _building.pop(key, None)
+
+    return entry
+
+
+def cached_json_response(key, build):
+    _, body, etag = get_payload(key, build)
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(body, mimetype='application/json')
+
+    # Clients may keep the payload but have to revalidate it on every poll
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,80 @@
+import logging
+from datetime import timedelta
+
+import numpy as np
+
+import db_ops
+from models import db, Fixture
+
+logger = logging.getLogger('app')
+
+INSERT_BATCH_SIZE = 10000
+
+
+def round_robin(n_players, cycles=1):
+    # Berger-table (circle method) round-robin over player indices 0..n_players-1.
+    # Returns (matchday, white, black) arrays with one entry per game. Each cycle has n-1 matchdays (n if n is odd,
+    # byes are dropped) and every other cycle swaps colors, so cycles=2 is a double round-robin.
+    # Within a cycle every player gets as balanced a color count as possible and never more than two equal colors
+    # in a row.
+    n = n_players + n_players % 2  # Odd fields get a phantom player whose opponent has a bye
+    m = n - 1
+    days = np.arange(m)
+
+    # Position j of matchday r holds player (j + r) mod m. Player n-1 stays put
+    rotation = (np.arange(m)[None, :] + days[:, None]) % m
+
+    fixed_white = days % 2 == 0
+    white = [np.where(fixed_white, rotation[:, 0], n - 1)]
+    black = [np.where(fixed_white, n - 1, rotation[:, 0])]
+    for i in range(1, n // 2):
+        a, b = rotation[:, i], rotation[:, m - i]
+        white.append(b if i % 2 else a)
+        black.append(a if i % 2 else b)
+
+    matchday = np.repeat(days[:, None], n // 2, axis=1).T.ravel()
+    white, black = np.concatenate(white), np.concatenate(black)
+
+    order = np.argsort(matchday, kind='stable')
+    matchday, white, black = matchday[order], white[order], black[order]
+
+    real = (white < n_players) & (black < n_players)
+    matchday, white, black = matchday[real], white[real], black[real]
+
+    swapped = np.arange(cycles) % 2 == 1
+    return (np.concatenate([matchday + c * m for c in range(cycles)]),
+            np.concatenate([black if swapped[c] else white for c in range(cycles)]),
+            np.concatenate([white if swapped[c] else black for c in range(cycles)]))
+
+
+def schedule_event(event, players=None, cycles=1):
+    # Creates the fixtures of an event from a Berger schedule. The cycles * (n-1) matchdays are split evenly over
+    # event.n_rounds; each round takes its deadline (days after the start date) and time format from
+    # event.rounds_duration and event.rounds_time_format. Returns the number of fixtures created.
+    # An event is scheduled once: one that already has fixtures is refused rather than given a second set
+    if db.session.query(Fixture.query.filter_by(event_id=event.id).exists()).scalar():
+        raise ValueError(f'Event {event.id} already has fixtures')
+
+    players = list(players if players is not None else event.players)
+    matchday, white, black = round_robin(len(players), cycles)
+    n_matchdays = int(matchday.max()) + 1 if len(matchday) else 0
+
+    round_number = matchday * event.n_rounds // max(n_matchdays, 1) + 1
+    deadlines = [event.start_date + timedelta(days) for days in event.rounds_duration]
+    time_formats = event.rounds_time_format
+
+    logger.info(f'Scheduling {len(white)} fixtures for event {event.id} '
+                f'({len(players)} players, {n_matchdays} matchdays, {event.n_rounds} rounds)')
+
+    players = np.array(players, dtype=object)
+    rows = [{'event_id': event.id, 'round_number': r, 'white': w, 'black': b,
+             'deadline': deadlines[r - 1],
+             'time_base': time_formats[r - 1]['base'], 'time_increment': time_formats[r - 1]['increment']}
+            for r, w, b in zip(round_number.tolist(), players[white].tolist(), players[black].tolist())]
+
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        db.session.execute(Fixture.__table__.insert(), rows[start:start + INSERT_BATCH_SIZE])
+
+    db_ops._rebuild_event_standings(event)
+    db.session.commit()
+    return len(rows)
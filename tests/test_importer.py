@@ -0,0 +1,146 @@
+import json
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import importer
+import lichess
+from app import create_app
+from models import db, Event, Fixture, Game, Member
+
+# The import pipeline end to end against a local stand-in for lichess: exports are fetched over HTTP from a stub
+# server, matched to fixtures, validated and stored
+
+
+def game_export(game_id, white, black, created_at, winner='white', clock=(600, 0)):
+    gamedata = {'id': game_id, 'status': 'mate', 'createdAt': int(created_at.timestamp() * 1000),
+                'players': {'white': {'user': {'id': white}}, 'black': {'user': {'id': black}}},
+                'clock': {'initial': clock[0], 'increment': clock[1]}}
+    if winner != 'draw':
+        gamedata['winner'] = winner
+    return gamedata
+
+
+class StubLichess(BaseHTTPRequestHandler):
+    exports = {}
+    rate_limited = set()  # Game ids answered once with a 429 before the export
+    requests = []
+
+    def do_GET(self):
+        game_id = self.path.rsplit('/', 1)[-1]
+        self.requests.append(self.path)
+
+        if game_id in self.rate_limited:
+            self.rate_limited.discard(game_id)
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+
+        if not self.path.startswith('/game/export/') or game_id not in self.exports:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = json.dumps(self.exports[game_id]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImporterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StubLichess)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StubLichess.exports, StubLichess.rate_limited, StubLichess.requests = {}, set(), []
+        self.client = lichess.LichessClient(base_url=self.base_url, max_retries=1)
+
+        self.app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        self.now = datetime.utcnow()
+        for member_id in ['alice', 'bob', 'carol']:
+            db.session.add(Member(lichess_id=member_id, acl_username=member_id, acl_elo=1000, date_joined=self.now))
+
+        closed = Event(start_date=self.now, active=False, n_rounds=1, closed_at=self.now)
+        self.event = Event(start_date=self.now, active=True, n_rounds=2)
+        db.session.add_all([closed, self.event])
+        db.session.flush()
+
+        fixture = lambda event, round_number, deadline: Fixture(event_id=event.id, round_number=round_number,
+                                                                white='alice', black='bob', deadline=deadline.date(),
+                                                                time_base=600, time_increment=0)
+        self.closed_fixture = fixture(closed, 1, self.now + timedelta(days=7))
+        self.expired_fixture = fixture(self.event, 1, self.now - timedelta(days=7))
+        self.open_fixture = fixture(self.event, 2, self.now + timedelta(days=7))
+        db.session.add_all([self.closed_fixture, self.expired_fixture, self.open_fixture])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def write_gamelist(self, game_ids):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = Path(directory.name) / 'gamelist.json'
+        path.write_text(json.dumps([f'https://lichess.org/{game_id}abcd' for game_id in game_ids]))
+        return path
+
+    def test_fetch_game_exports_skips_failures_and_retries_rate_limits(self):
+        StubLichess.exports['game0001'] = game_export('game0001', 'alice', 'bob', self.now)
+        StubLichess.exports['game0002'] = game_export('game0002', 'bob', 'alice', self.now)
+        StubLichess.rate_limited.add('game0002')
+
+        exports = importer.fetch_game_exports(['game0001', 'game0002', 'missing1'], client=self.client)
+
+        self.assertEqual(sorted(g['id'] for g in exports), ['game0001', 'game0002'])
+        self.assertEqual(StubLichess.requests.count('/game/export/game0002'), 2)
+
+    def test_import_gamelist_falls_through_to_next_open_fixture(self):
+        StubLichess.exports['game0001'] = game_export('game0001', 'alice', 'bob', self.now)
+        StubLichess.exports['game0002'] = game_export('game0002', 'alice', 'carol', self.now)  # No such fixture
+
+        imported = importer.import_gamelist(self.write_gamelist(['game0001', 'game0002', 'missing1']),
+                                            client=self.client)
+
+        self.assertEqual(imported, ['game0001'])
+        # Skips the closed event's fixture and the round past its deadline
+        self.assertIsNone(Fixture.query.get(self.closed_fixture.id).game_id)
+        self.assertIsNone(Fixture.query.get(self.expired_fixture.id).game_id)
+        self.assertEqual(Fixture.query.get(self.open_fixture.id).game_id, 'game0001')
+        self.assertEqual(Game.query.get('game0001').event_id, self.event.id)
+        self.assertEqual(Member.query.get('alice').acl_elo, 1016)
+
+    def test_import_gamelist_rejects_game_without_valid_fixture(self):
+        StubLichess.exports['game0001'] = game_export('game0001', 'alice', 'bob', self.now, clock=(300, 3))
+
+        imported = importer.import_gamelist(self.write_gamelist(['game0001']), client=self.client)
+
+        self.assertEqual(imported, [])
+        self.assertEqual(Game.query.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+
+from cachetools import TTLCache
+from flask import has_request_context, session
+
+import metrics
+from models import User
+
+# User snapshots for the login manager's user_loader, so authenticated requests don't query the users table just
+# to know who is asking. Entries hold column values, and every load builds a fresh transient User from them, so a
+# request can neither change the cached copy nor attach it to its session.
+# create_user and update_user_lichess_data invalidate a user's entry in this process. Other processes serve theirs
+# until USER_CACHE_TTL runs out.
+# With SESSION_USER_SNAPSHOT the fields User.json() needs are also kept in the (signed) session cookie, and users
+# are loaded from it without touching the cache or the database. Those users only carry SESSION_FIELDS.
+
+SESSION_KEY = '_user_snapshot'
+SESSION_FIELDS = ('id', 'username', 'aelo', 'lichess_id', 'lichess_connected', 'lichess_rapid_elo', 'lichess_blitz_elo')
+
+_cache = TTLCache(maxsize=1024, ttl=300)
+_lock = threading.Lock()
+_generation = 0  # Bumped by invalidate, so a load that raced with it does not store the old values
+_use_session = False
+
+
+def configure(maxsize, ttl, use_session=False):
+    global _cache, _use_session
+    with _lock:
+        _cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        _use_session = use_session
+
+
+def load(user_id, load_from_db):
+    if _use_session and has_request_context():
+        snapshot = session.get(SESSION_KEY)
+        if snapshot is not None and snapshot.get('id') == user_id:
+            metrics.user_loads.inc('session')
+            return User(**snapshot)
+
+    with _lock:
+        values = _cache.get(user_id)
+        generation = _generation
+
+    if values is not None:
+        metrics.user_loads.inc('cache')
+        return User(**values)
+
+    metrics.user_loads.inc('database')
+    user = load_from_db(user_id)
+    if user is None:
+        return None
+
+    values = {column.key: getattr(user, column.key) for column in User.__table__.columns}
+    with _lock:
+        if generation == _generation:
+            _cache[user_id] = values
+
+    remember_in_session(user)
+    return User(**values)
+
+
+def remember_in_session(user):
+    if _use_session and has_request_context():
+        session[SESSION_KEY] = {field: getattr(user, field) for field in SESSION_FIELDS}
+
+
+def forget_session():
+    if has_request_context():
+        session.pop(SESSION_KEY, None)
+
+
+def invalidate(user_id):
+    global _generation
+    with _lock:
+        _cache.pop(user_id, None)
+        _generation += 1
+
+    if has_request_context() and session.get(SESSION_KEY, {}).get('id') == user_id:
+        forget_session()
+
+
+def clear():
+    global _generation
+    with _lock:
+        _cache.clear()
+        _generation += 1